@@ -9,28 +9,41 @@
 # Importing necessary Python packages --------------------------- #
 
 import os
+import numpy as np
 import pandas as pd
-import arcpy
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from TableStore import WriteStore, ReadStore, PartitionTable, WritePartitions
 
 # Time reference ------------------------------------------------ #
 
-## Number of years
+## Number of years (taken in order from the STORM files)
 YearNum = 250 
 
+## Number of years in each STORM file
+FileYears = 1000
+
+## Number of STORM files needed
+FileNum = (YearNum + FileYears - 1) // FileYears
+
+## Number of years in each parallel selection shard
+ShardYears = 50
+
 # Spatial reference --------------------------------------------- #
 
-## Geographic coordinate system
-GeoReference = '''GEOGCS['GCS_WGS_1984'
-                ,DATUM['D_WGS_1984'
-                ,SPHEROID['WGS_1984',6378137.0,298.257223563]]
-                ,PRIMEM['Greenwich',0.0]
-                ,UNIT['Degree',0.0174532925199433]]
-                ;-400 -400 1000000000
-                ;-100000 10000
-                ;-100000 10000
-                ;8.98315284119522E-09
-                ;0.001;0.001
-                ;IsHighPrecision'''
+## Mean radius of the Earth (km)
+EarthRadius = 6371.0088
+
+## Radius(km) of the buffer polygon used as distance reference
+BufferRadius = 200
+
+## Radius(km) for extracting track points around Hainan Island
+ClipRadius = 800
+
+## Extent(km) and cell size(degree) of the distance-to-coast field
+FieldRadius = 1000
+FieldCell = 0.05
 
 # Input/Output settings ----------------------------------------- #
 
@@ -39,27 +52,22 @@ root = os.path.join(System, r"Project_StormSurge")
 ModuleA_dir = os.path.join(root, r"ModuleA")
 
 prepare_dir = os.path.join(ModuleA_dir, "Prepare")  # Folder for prepared data
-encode_dir = os.path.join(ModuleA_dir, "Encode")  # Folder for encoded data (N+[Year 3 characters]+[Number 2 characters])
 table_encode_dir = os.path.join(ModuleA_dir, "TableByCode")  # Folder for output tables by Code
 table_year_dir = os.path.join(ModuleA_dir, "TableByYear")  # Folder for output tables by Year
-point_year_dir = os.path.join(ModuleA_dir, "PointByYear")  # Folder for points(.shp) by Year
-line_year_dir = os.path.join(ModuleA_dir, "LineByYear")  # Folder for lines(.shp) by Year
-merge_dir = os.path.join(ModuleA_dir, "Merge")  # Folder for merge lines
 select_dir = os.path.join(ModuleA_dir, "Select")  # Folder for selected landfall tracks
-point_encode_dir = os.path.join(ModuleA_dir, "PointByCode")  # Folder for points(.shp) by Code
-range_dir = os.path.join(ModuleA_dir, "Range")  # Folder for extracted points within 800km buffer zone
-record_dir = os.path.join(ModuleA_dir, "Record")  # Folder for table records converted from points(.shp)
+record_dir = os.path.join(ModuleA_dir, "Record")  # Folder for table records by REid
+store_dir = os.path.join(ModuleA_dir, "Store")  # Folder for columnar stores (one binary file per column)
 
-txt_path = os.path.join(prepare_dir, "STORM_DATA_IBTRACS_WP_1000_YEARS_0.txt") # Original data of STORM dataset(.txt)
-csv_path = os.path.join(prepare_dir, "STORM_DATA_IBTRACS_WP_1000_YEARS_0.csv") # Processed data of STORM dataset(.csv)
 buf200_path = os.path.join(prepare_dir, "Hainan_Buffer200km.shp") # Buffer of Hainan Island with 200km radius
-buf800_path = os.path.join(prepare_dir, "Hainan_Buffer800km.shp") # Buffer of Hainan Island with 800km radius
+distance_path = os.path.join(prepare_dir, "Hainan_Distance.npz") # Distance-to-coast field of Hainan Island
 
-encode_path = os.path.join(encode_dir, "STORM_IBTRACS_Code_" + str(YearNum) + "yr.xlsx") # Encoded data of STORM dataset(.xlsx)
-merge_line_path = os.path.join(merge_dir, "Merge_" + str(YearNum) + "yr_1.shp") # Merged lines(.shp) of TC tracks
+listTxtPath = [os.path.join(prepare_dir, "STORM_DATA_IBTRACS_WP_1000_YEARS_" + str(i) + ".txt")
+               for i in range(FileNum)] # Original data of STORM dataset(.txt)
+listStoreDir = [os.path.join(store_dir, "STORM_DATA_IBTRACS_WP_1000_YEARS_" + str(i))
+                for i in range(FileNum)] # Columnar stores of STORM dataset
 
 select_table_path = os.path.join(select_dir, "Select_" + str(YearNum) + "yr_buf200km.xlsx") # Selected table records(.xlsx) of TC tracks 
-select_line_path = os.path.join(select_dir, "Select_" + str(YearNum) + "yr_buf200km_1.shp") # Selected lines(.shp) of TC tracks 
+select_store_dir = os.path.join(store_dir, "Select_" + str(YearNum) + "yr_buf200km") # Columnar store of selected TC tracks
 
 # Global Constants ---------------------------------------------- #
 
@@ -68,140 +76,290 @@ Header = ['Year', 'Month', 'Number', 'Time', 'Basin',
           'LAT', 'LONG', 'MP', 'MWS', 'RMW',
           'Category', 'Landfall', 'Distance']
 
+## Compact data types of STORM dataset
+HeaderType = {'Year': 'int16', 'Month': 'int8', 'Number': 'int16', 'Time': 'int16', 'Basin': 'int8',
+              'LAT': 'float32', 'LONG': 'float32', 'MP': 'float32', 'MWS': 'float32', 'RMW': 'float32',
+              'Category': 'int8', 'Landfall': 'int8', 'Distance': 'float32'}
+
+## Number of text lines parsed at a time
+ChunkSize = 1000000
+
+## Export partition tables(.xlsx) by Code/Year/REid
+ExportExcel = False
+
+## Width of the year code in TCid
+YearWidth = max(3, len(str(YearNum - 1)))
+
+## Number of worker processes
+WorkerNum = os.cpu_count()
+
 ######################################## Main Program ###########################################
 
-# Convert original data format (txt->csv) =========================================== #
-
-df = pd.read_csv(txt_path)
-df = pd.DataFrame(df)
-df.to_csv(csv_path, header=Header, index=False)
-
-# Encoding (N+[Year 3 characters]+[Number 2 characters]) ==================================== #
-
-dfFrom = pd.read_csv(csv_path)
-dfYear = dfFrom[dfFrom["Year"] < YearNum]
-
-listTCid = []
-for i in range(len(dfYear)):
-    dfTemp = dfYear.iloc[i]
-    tcid = "TC" + str(int(dfTemp["Year"]) + 1000)[-3:] + str(int(dfTemp["Number"]) + 100)[-2:]
-    listTCid.append(tcid)
-dfYear["TCid"] = listTCid
-dfYear.to_excel(encode_path, index=False)
-print(encode_path)
-
-# Output tables by Code ============================================================= #
-
-dfFrom = pd.read_excel(encode_path)
-listTCid = list(set(dfFrom["TCid"])) 
-print(listTCid)
-
-for i in range(len(listTCid)):
-    dfTo = dfFrom[dfFrom["TCid"] == listTCid[i]]
-    tcid_path = os.path.join(table_encode_dir, listTCid[i] + ".xlsx")
-    dfTo.to_excel(tcid_path, index=False)
-    print(tcid_path)
-
-# Output tables by Year ============================================================= #
-
-dfFrom = pd.read_excel(encode_path)
-for year in range(YearNum):
-    yearid = "Y" + str(year + 1000)[-3:]
-    year_path = os.path.join(table_year_dir, yearid + ".xlsx")
-    dfTo = dfFrom[dfFrom["Year"] == year]
-    dfTo.to_excel(year_path, index=False)
-    print(year_path)
-
-# Generate points(.shp) by Year ===================================================== #
-
-for year in range(YearNum):
-    yearid = "Y" + str(year + 1000)[-3:]
-    table_year_path = os.path.join(table_year_dir, yearid + ".xlsx\Sheet1$")
-    point_year_path = os.path.join(point_year_dir, yearid + "_0.shp")
-    arcpy.management.Delete(yearid)
-    arcpy.MakeXYEventLayer_management(table_year_path, "LONG", "LAT", yearid, GeoReference, "")
-    arcpy.CopyFeatures_management(yearid, point_year_path)
-    print(point_year_path)    
-
-# Generate lines(.shp) by Year ====================================================== #
-
-for year in range(YearNum):
-    yearid = "Y" + str(year + 1000)[-3:]
-    point_year_path = os.path.join(point_year_dir, yearid + "_0.shp")
-    line_year_path = os.path.join(line_year_dir, yearid + "_1.shp")
-    arcpy.PointsToLine_management(point_year_path, line_year_path, "Number", "Time", "NO_CLOSE")
-    arcpy.JoinField_management(line_year_path, "Number", point_year_path, "Number", fields=["Year", "TCid"])
-    print(line_year_path)
-
-# Merge lines ======================================================================= #
-
-listLine = []
-for year in range(YearNum): 
-    yearid = "Y" + str(year + 1000)[-3:] 
-    line_year_path = os.path.join(line_year_dir, yearid + r"_1.shp")
-    listLine.append(line_year_path)
-arcpy.management.Merge(inputs=listLine, output=merge_line_path, field_mappings="", add_source="NO_SOURCE_INFO")
-print(merge_line_path)
-
-# Select lines passing 200km buffer zone  =========================================== #
-
-tempLayer = arcpy.management.SelectLayerByLocation(in_layer=merge_line_path,
-                                                   overlap_type="INTERSECT",
-                                                   select_features=buf200_path,
-                                                   search_distance="0 DecimalDegrees",
-                                                   selection_type="NEW_SELECTION",
-                                                   invert_spatial_relationship="NOT_INVERT")
-
-arcpy.management.CopyFeatures(in_features=tempLayer, out_feature_class=select_line_path,
-                              config_keyword="", spatial_grid_1=None,
-                              spatial_grid_2=None, spatial_grid_3=None)
-
-arcpy.conversion.TableToExcel(Input_Table=select_line_path, Output_Excel_File=select_table_path,
-                              Use_field_alias_as_column_header="NAME", Use_domain_and_subtype_description="CODE")
-
-df = pd.read_excel(select_table_path)
-listReID = []
-for i in range(len(df)):
-    reid = "RE" + str(10000 + i)[-4:]
-    listReID.append(reid)
-df["REid"] = listReID
-df.to_excel(select_table_path, index=False)
-
-# Generate points(.shp) by Code ===================================================== #
-
-df = pd.read_excel(select_table_path)
-for i in range(len(df)):
-    dfTemp = df.iloc[i]
-    tcid = str(dfTemp["TCid"])
-    reid = str(dfTemp["REid"])
-    table_code_path = os.path.join(table_encode_dir, tcid + r".xlsx\Sheet1$")
-    point_code_path = os.path.join(point_encode_dir, reid + r"_0.shp")
-    arcpy.MakeXYEventLayer_management(table_code_path, "LONG", "LAT", reid, GeoReference, "")
-    arcpy.CopyFeatures_management(reid, point_code_path)
-    print(point_code_path)
-
-# Extract points within 800km buffer zone =========================================== #
-
-df = pd.read_excel(select_table_path)
-for i in range(len(df)):
-    dfTemp = df.iloc[i]
-    reid = str(dfTemp["REid"])
-    point_code_path = os.path.join(point_encode_dir, reid + r"_0.shp")
-    range_path = os.path.join(range_dir, reid + r"_0.shp") 
-    arcpy.analysis.Clip(in_features=point_code_path, clip_features=buf800_path,
-                        out_feature_class=range_path, cluster_tolerance="")
-    print(range_path)
-
-# Convert points(.shp) to table records(.xlsx) ====================================== #
-
-df = pd.read_excel(select_table_path)
-for i in range(len(df)):
-    dfTemp = df.iloc[i]
-    reid = str(dfTemp["REid"])
-    range_path = os.path.join(range_dir, reid + r"_0.shp")
-    record_path = os.path.join(record_dir, reid + ".xlsx")  
-    arcpy.conversion.TableToExcel(Input_Table=range_path,
-                                  Output_Excel_File=record_path,
-                                  Use_field_alias_as_column_header="NAME",
-                                  Use_domain_and_subtype_description="CODE")
-    print(record_path)
\ No newline at end of file
+# Columnar store ==================================================================== #
+
+## Parse STORM dataset(.txt) chunk by chunk into a columnar store
+def IngestStorm(txt_path, store_dir):
+    reader = pd.read_csv(txt_path, header=None, names=Header, chunksize=ChunkSize)
+    for i, chunk in enumerate(reader):
+        WriteStore(store_dir, chunk.astype(HeaderType), append=i > 0)
+    return store_dir
+
+# Encoding (TC+[Year]+[Number 2 characters]) ======================================= #
+
+## Encode TC tracks (the year code widens beyond 999 years)
+def EncodeTCid(year, number):
+    codeYear = pd.Series(np.asarray(year, dtype=int)).astype(str).str.zfill(YearWidth)
+    codeNumber = pd.Series(np.asarray(number, dtype=int)).astype(str).str.zfill(2)
+    return ("TC" + codeYear + codeNumber).to_numpy()
+
+## Code of a year for tables by Year
+def YearCode(year):
+    return "Y" + str(year).zfill(YearWidth)
+
+# Select tracks passing 200km buffer zone =========================================== #
+
+## Read polygon rings(lon, lat) from a shapefile(.shp)
+def ReadPolygonShp(shp_path):
+    with open(shp_path, 'rb') as shp:
+        data = shp.read()
+    rings = []
+    pos = 100  # Skip file header
+    while pos < len(data):
+        length = int.from_bytes(data[pos + 4:pos + 8], 'big') * 2  # Content length in bytes
+        content = pos + 8
+        shapeType = np.frombuffer(data, '<i4', 1, offset=content)[0]
+        if shapeType in (5, 15, 25):  # Polygon, PolygonZ, PolygonM
+            partNum, pointNum = np.frombuffer(data, '<i4', 2, offset=content + 36)
+            parts = np.frombuffer(data, '<i4', partNum, offset=content + 44)
+            points = np.frombuffer(data, '<f8', 2 * pointNum, offset=content + 44 + 4 * partNum).reshape(-1, 2)
+            for start, stop in zip(parts, list(parts[1:]) + [pointNum]):
+                rings.append(points[start:stop])
+        pos = content + length
+    return rings
+
+## Index polygon edges by latitude bands
+def BuildEdgeIndex(rings, bandNum=64):
+    edges = np.concatenate([np.hstack([ring[:-1], ring[1:]]) for ring in rings])  # x1, y1, x2, y2
+    edges = edges[np.any(edges[:, :2] != edges[:, 2:], axis=1)]
+    edgeMin = np.minimum(edges[:, 1], edges[:, 3])
+    edgeMax = np.maximum(edges[:, 1], edges[:, 3])
+    bandY = np.linspace(edgeMin.min(), edgeMax.max(), bandNum + 1)
+    bands = [np.flatnonzero((edgeMin <= bandY[k + 1]) & (edgeMax >= bandY[k])) for k in range(bandNum)]
+    bounds = (edges[:, [0, 2]].min(), edgeMin.min(), edges[:, [0, 2]].max(), edgeMax.max())
+    return {"edges": edges, "bounds": bounds, "bandY": bandY, "bands": bands}
+
+## Band numbers of latitudes (-1 outside the index)
+def EdgeBand(index, y):
+    bandY = index["bandY"]
+    band = np.searchsorted(bandY, y, side="right") - 1
+    band[y == bandY[-1]] = len(bandY) - 2
+    band[(y < bandY[0]) | (y > bandY[-1])] = -1
+    return band
+
+## Even-odd test of points against the indexed polygon
+def PointInPolygon(x, y, index, chunk=65536):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    xmin, ymin, xmax, ymax = index["bounds"]
+    inside = np.zeros(len(x), dtype=bool)
+    band = EdgeBand(index, y)
+    band[(x < xmin) | (x > xmax)] = -1
+    for k in np.unique(band[band >= 0]):
+        x1, y1, x2, y2 = index["edges"][index["bands"][k]].T
+        points = np.flatnonzero(band == k)
+        for start in range(0, len(points), chunk):
+            sub = points[start:start + chunk]
+            px, py = x[sub, None], y[sub, None]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cross = ((y1 > py) != (y2 > py)) & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+            inside[sub] = np.count_nonzero(cross, axis=1) % 2 == 1
+    return inside
+
+## Test segments(x1, y1 -> x2, y2) for crossing any indexed polygon edge
+def SegmentCrossPolygon(sx1, sy1, sx2, sy2, index, chunk=65536):
+    xmin, ymin, xmax, ymax = index["bounds"]
+    cross = np.zeros(len(sx1), dtype=bool)
+    candidate = ((np.maximum(sx1, sx2) >= xmin) & (np.minimum(sx1, sx2) <= xmax)
+                 & (np.maximum(sy1, sy2) >= ymin) & (np.minimum(sy1, sy2) <= ymax))
+    segLow = np.minimum(sy1, sy2)
+    segHigh = np.maximum(sy1, sy2)
+    bandY = index["bandY"]
+    for k in range(len(index["bands"])):
+        segments = np.flatnonzero(candidate & ~cross & (segLow <= bandY[k + 1]) & (segHigh >= bandY[k]))
+        if len(segments) == 0 or len(index["bands"][k]) == 0:
+            continue
+        ex1, ey1, ex2, ey2 = index["edges"][index["bands"][k]].T
+        for start in range(0, len(segments), chunk):
+            sub = segments[start:start + chunk]
+            px1, py1, px2, py2 = sx1[sub, None], sy1[sub, None], sx2[sub, None], sy2[sub, None]
+            d1 = (ex2 - ex1) * (py1 - ey1) - (ey2 - ey1) * (px1 - ex1)
+            d2 = (ex2 - ex1) * (py2 - ey1) - (ey2 - ey1) * (px2 - ex1)
+            d3 = (px2 - px1) * (ey1 - py1) - (py2 - py1) * (ex1 - px1)
+            d4 = (px2 - px1) * (ey2 - py1) - (py2 - py1) * (ex2 - px1)
+            overlap = ((np.maximum(px1, px2) >= np.minimum(ex1, ex2)) & (np.minimum(px1, px2) <= np.maximum(ex1, ex2))
+                       & (np.maximum(py1, py2) >= np.minimum(ey1, ey2)) & (np.minimum(py1, py2) <= np.maximum(ey1, ey2)))
+            cross[sub] = np.any((d1 * d2 <= 0) & (d3 * d4 <= 0) & overlap, axis=1)
+    return cross
+
+## Select tracks (sorted by TCid) whose lines intersect the indexed polygon
+def SelectTracks(dfTrack, index):
+    tcid = dfTrack["TCid"].to_numpy().astype(str)
+    change = np.r_[True, tcid[1:] != tcid[:-1]][:len(tcid)]
+    first = np.flatnonzero(change)  # First point of each track
+    group = np.cumsum(change) - 1
+    order = np.lexsort((dfTrack["Time"].to_numpy(), group))  # Order points by Time within each track
+    x = dfTrack["LONG"].to_numpy()[order].astype(np.float64)
+    y = dfTrack["LAT"].to_numpy()[order].astype(np.float64)
+    group = group[order]
+
+    hit = PointInPolygon(x, y, index)
+    segment = np.flatnonzero((group[1:] == group[:-1]) & ~hit[1:] & ~hit[:-1])
+    hitSegment = SegmentCrossPolygon(x[segment], y[segment], x[segment + 1], y[segment + 1], index)
+
+    select = np.zeros(len(first), dtype=bool)
+    select[group[hit]] = True
+    select[group[segment[hitSegment]]] = True
+
+    dfSelect = dfTrack.iloc[first[select]]
+    df = pd.DataFrame({"FID": np.arange(len(dfSelect)), "Id": 0,
+                       "Number": dfSelect["Number"].to_numpy().astype(int),
+                       "Year": dfSelect["Year"].to_numpy().astype(int),
+                       "TCid": dfSelect["TCid"].to_numpy().astype(str)})
+    return df
+
+# Extract points within 800km of Hainan Island ====================================== #
+
+## Unit vectors on the sphere for longitudes/latitudes
+def UnitSphere(lon, lat):
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+## Build the geodesic distance-to-coast field from a buffer polygon of the island
+def BuildDistanceField(rings, bufferRadius, fieldRadius, cellSize):
+    # Densify the buffer boundary to half a cell
+    boundary = []
+    for ring in rings:
+        step = np.hypot(*np.diff(ring, axis=0).T)
+        count = np.maximum(np.ceil(step / (cellSize / 2)).astype(int), 1)
+        for (x1, y1), (x2, y2), n in zip(ring[:-1], ring[1:], count):
+            t = np.arange(n) / n
+            boundary.append(np.column_stack([x1 + (x2 - x1) * t, y1 + (y2 - y1) * t]))
+    boundary = np.concatenate(boundary)
+    tree = cKDTree(UnitSphere(boundary[:, 0], boundary[:, 1]))
+
+    # Grid covering every point within fieldRadius of the coast
+    index = BuildEdgeIndex(rings)
+    xmin, ymin, xmax, ymax = index["bounds"]
+    marginLat = (fieldRadius - bufferRadius) / EarthRadius * 180 / np.pi
+    marginLon = marginLat / np.cos(np.radians(min(max(abs(ymin), abs(ymax)) + marginLat, 89.0)))
+    lon = np.arange(xmin - marginLon, xmax + marginLon + cellSize, cellSize)
+    lat = np.arange(ymin - marginLat, ymax + marginLat + cellSize, cellSize)
+    gridLon, gridLat = np.meshgrid(lon, lat)
+
+    # Signed distance to the buffer boundary, shifted by the buffer radius
+    chord = tree.query(UnitSphere(gridLon.ravel(), gridLat.ravel()))[0]
+    distance = 2 * EarthRadius * np.arcsin(np.minimum(chord / 2, 1.0))
+    inside = PointInPolygon(gridLon.ravel(), gridLat.ravel(), index)
+    distance = np.where(inside, -distance, distance) + bufferRadius
+    return {"lon": lon, "lat": lat, "distance": distance.reshape(gridLat.shape).astype(np.float32)}
+
+## Load the distance field, rebuilding it when the buffer polygon has changed
+def LoadDistanceField(shp_path, field_path):
+    stamp = os.path.getmtime(shp_path)
+    if os.path.exists(field_path):
+        field = dict(np.load(field_path))
+        if field["stamp"] == stamp and field["radius"] == FieldRadius and field["cell"] == FieldCell:
+            return field
+    field = BuildDistanceField(ReadPolygonShp(shp_path), BufferRadius, FieldRadius, FieldCell)
+    field.update(stamp=stamp, radius=FieldRadius, cell=FieldCell)
+    np.savez(field_path, **field)
+    return field
+
+## Bilinear lookup of distances (km) to the coast (inf outside the field)
+def LookupDistance(field, lon, lat):
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    gridLon, gridLat, distance = field["lon"], field["lat"], field["distance"]
+    fx = (lon - gridLon[0]) / (gridLon[1] - gridLon[0])
+    fy = (lat - gridLat[0]) / (gridLat[1] - gridLat[0])
+    valid = (fx >= 0) & (fx <= len(gridLon) - 1) & (fy >= 0) & (fy <= len(gridLat) - 1)
+    ix = np.clip(np.floor(fx).astype(int), 0, len(gridLon) - 2)
+    iy = np.clip(np.floor(fy).astype(int), 0, len(gridLat) - 2)
+    wx = np.clip(fx - ix, 0, 1)
+    wy = np.clip(fy - iy, 0, 1)
+    value = ((distance[iy, ix] * (1 - wx) + distance[iy, ix + 1] * wx) * (1 - wy)
+             + (distance[iy + 1, ix] * (1 - wx) + distance[iy + 1, ix + 1] * wx) * wy)
+    return np.where(valid, value, np.inf)
+
+## Extract the points of selected tracks within a radius(km) of the coast
+def ClipTracks(dfTrack, trackIndex, listTCid, field, radius):
+    listRow = [np.arange(*trackIndex[tcid]) for tcid in listTCid]
+    dfRecord = dfTrack.iloc[np.concatenate([np.zeros(0, dtype=int)] + listRow)].reset_index(drop=True)
+    keep = LookupDistance(field, dfRecord["LONG"], dfRecord["LAT"]) <= radius
+    return dfRecord[keep].reset_index(drop=True)
+
+# Parallel selection over STORM files =============================================== #
+
+## Shards of (file number, first year, last year + 1) covering all years
+def ListShards():
+    shards = []
+    for file in range(FileNum):
+        first = file * FileYears
+        last = min(first + FileYears, YearNum)
+        for start in range(first, last, ShardYears):
+            shards.append((file, start, min(start + ShardYears, last)))
+    return shards
+
+## Encode -> select -> clip the tracks of one shard
+def RunShard(shard, index, field):
+    file, start, stop = shard
+    dfFrom = ReadStore(listStoreDir[file])
+    year = dfFrom["Year"].to_numpy().astype(int) + file * FileYears  # Global year over all files
+    rows = np.flatnonzero((year >= start) & (year < stop))
+    dfCode = dfFrom.iloc[rows].reset_index(drop=True)
+    dfCode["Year"] = year[rows].astype(HeaderType["Year"])
+    dfCode["TCid"] = EncodeTCid(dfCode["Year"], dfCode["Number"])
+    dfCode, trackIndex = PartitionTable(dfCode, "TCid")
+    dfSelect = SelectTracks(dfCode, index)
+    dfRecord = ClipTracks(dfCode, trackIndex, dfSelect["TCid"], field, ClipRadius)
+    return dfCode, dfSelect, dfRecord
+
+if __name__ == "__main__":
+
+    index200 = BuildEdgeIndex(ReadPolygonShp(buf200_path))
+    field = LoadDistanceField(buf200_path, distance_path)
+    shards = ListShards()
+
+    listSelect = []
+    listRecord = []
+    with ProcessPoolExecutor(max_workers=WorkerNum) as pool:
+
+        ## Convert original data format (txt->store)
+        for storm_store_dir in pool.map(IngestStorm, listTxtPath, listStoreDir):
+            print(storm_store_dir)
+
+        ## Encode, select and clip by shards, output tables by Code/Year in shard order
+        results = pool.map(RunShard, shards, repeat(index200), repeat(field))
+        for i, (shard, (dfCode, dfSelect, dfRecord)) in enumerate(zip(shards, results)):
+            WritePartitions(dfCode, "TCid", table_encode_dir, xlsx=ExportExcel, append=i > 0)
+            WritePartitions(dfCode, "Year", table_year_dir, YearCode, listKey=np.arange(shard[1], shard[2]),
+                            xlsx=ExportExcel, append=i > 0)
+            listSelect.append(dfSelect)
+            listRecord.append(dfRecord)
+            print(shard)
+
+    ## Merge shards and assign REid
+    df = pd.concat(listSelect, ignore_index=True)
+    df["FID"] = np.arange(len(df))
+    codeRun = pd.Series(np.arange(len(df))).astype(str).str.zfill(max(4, len(str(len(df) - 1))))
+    df["REid"] = ("RE" + codeRun).to_numpy()
+    df.to_excel(select_table_path, index=False)
+    WriteStore(select_store_dir, df)
+    print(select_table_path)
+
+    ## Output table records by REid
+    dfRecord = pd.concat(listRecord, ignore_index=True)
+    dfRecord["REid"] = dfRecord["TCid"].map(dict(zip(df["TCid"], df["REid"])))
+    WritePartitions(dfRecord, "REid", record_dir, xlsx=ExportExcel)
+    print(record_dir)
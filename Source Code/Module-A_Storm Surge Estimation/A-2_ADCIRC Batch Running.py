@@ -10,9 +10,18 @@
 
 import os
 import time
+import re
+import json
+import sqlite3
+import threading
+import subprocess
+import numpy as np
 import pandas as pd
 import datetime as dt
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from MeshCache import LoadMesh
+from TableStore import ReadStore
 
 # Time reference ------------------------------------------------ #
 
@@ -33,183 +42,412 @@ ModuleA_dir = os.path.join(root, r"ModuleA")
 
 prepare_dir = os.path.join(ModuleA_dir, "Prepare")  # Folder for prepared data
 select_dir = os.path.join(ModuleA_dir, "Select")  # Folder for selected landfall tracks
-record_dir = os.path.join(ModuleA_dir, "Record")  # Folder for table records converted from points(.shp)
+record_dir = os.path.join(ModuleA_dir, "Record")  # Folder for table records by REid
 format_dir = os.path.join(ModuleA_dir, "Format")  # Folder for input files of Fujita-Takahashi models
 windset_dir = os.path.join(ModuleA_dir, "Windset")  # Folder for control settings of Fujita-Takahashi models
 fort22_dir = os.path.join(ModuleA_dir, "Fort22")  # Folder for Fort22 files
 fort15_dir = os.path.join(ModuleA_dir, "Fort15")  # Folder for Fort15 files
 adcirc_dir = os.path.join(ModuleA_dir, "ADCIRC")  # Folder for batch running ADCIRC model files
+store_dir = os.path.join(ModuleA_dir, "Store")  # Folder for columnar stores (one binary file per column)
 
 fort13_path_in = os.path.join(prepare_dir, "fort.13") # Fort13 file
 fort14_path_in = os.path.join(prepare_dir, "fort.14") # Fort14 file
 fort15_path_in = os.path.join(prepare_dir, "fort.15") # Fort15 file
 adcirc_source = os.path.join(prepare_dir, "ADCIRC.exe") # ADCIRC program
+state_path = os.path.join(adcirc_dir, "BatchState.sqlite") # State of batch running ADCIRC models
 
-select_table_path = os.path.join(select_dir, "Select_" + str(YearNum) + "yr_buf200km.xlsx") # Selected table records(.xlsx) of TC tracks 
+select_store_dir = os.path.join(store_dir, "Select_" + str(YearNum) + "yr_buf200km") # Columnar store of selected TC tracks
 
 # Global Constants ---------------------------------------------- #
 
 ## Wind field control parameter
 chBool = True
 
-######################################## Main Program ###########################################
+## Parametric wind model for fort.22 ("FT": Fujita-Takahashi, "Holland"; None: external program)
+WindModel = "FT"
 
-# Generate input files for Fujita-Takahashi models ================================== #
+## Time increment (seconds) of fort.22, set as WTIMINC in fort.15 together with NWS = 5
+WindInterval = 3600
 
-df = pd.read_excel(select_table_path)
-for i in range(len(df)):
-    dfTemp = df.iloc[i]
-    reid = str(dfTemp["REid"])
-    
-    record_path = os.path.join(record_dir, reid + ".xlsx") 
-    format_path = os.path.join(format_dir, "StormPath" + reid + ".txt") 
-    
-    dfFrom = pd.read_excel(record_path)
-    datalist = []
-    for j in range(len(dfFrom)):
-        templist = []
-        lat = round(dfFrom["LAT"][j], 1)  # Round latitude to one decimal place
-        lon = round(dfFrom["LONG"][j], 1)  # Round longitude to one decimal place
-        tp = int(round(dfFrom["MP"][j], 0))  # Round central pressure to integer
-        mw = int(round(dfFrom["MWS"][j], 0))  # Round maximum wind speed to integer
-        hp = 1010  # Background pressure
-        
-        time = timeStart + dt.timedelta(hours=3) * j 
-        year = int(time.year)  # Year
-        month = int(time.month)  # Month
-        day = int(time.day)  # Day
-        hour = int(time.hour)  # Hour
-    
-        templist = [lat, lon, tp, mw, hp, year, month, day, hour]
-        datalist.append(templist)
+## Background pressure (hPa), inflow angle (degree), coefficients of moving and gradient winds
+BackgroundPressure = 1010
+InflowAngle = 20
+MoveCoef = 1.0
+GradientCoef = 0.8
 
-    dfTo = pd.DataFrame(datalist)
-    dfTo.to_csv(format_path, header=None, index=False, sep=' ')
-    print(format_path)
+## Physical constants (SI units)
+EarthRadius = 6371008.8
+Omega = 7.2921e-5
+AirDensity = 1.15
+WaterDensity = 1000.0
+Gravity = 9.81
 
-# Generate control settings for Fujita-Takahashi models ============================= #
+## Number of node values (times x nodes) evaluated at a time
+ChunkCells = 5000000
 
-df = pd.read_excel(select_table_path)
-for i in range(len(df)):
-    dfTemp = df.iloc[i]
-    reid = str(dfTemp["REid"])
-    
-    format_path = os.path.join(format_dir, "StormPath" + reid + ".txt") 
-    windset_path = os.path.join(windset_dir, "WindSet" + reid + ".txt")
-    
-    with open(format_path, 'r') as stormpath:
-        lines = stormpath.readlines()
-        firstline = lines[0].split()
-        startTime = firstline[-4:]
-        lastline = lines[len(lines)-1].split()
-        endTime = lastline[-4:]    
-    
-    startTime = dt.datetime(int(startTime[0]), int(startTime[1]), int(startTime[2]), int(startTime[3]), 0, 0)        
-    endTime = dt.datetime(int(endTime[0]), int(endTime[1]), int(endTime[2]), int(endTime[3]), 0, 0)
-    
+## Number of threads for writing files
+ThreadNum = 16
+
+## Extra fort.15 parameters for all runs, by name (e.g. {"DTDP": 2.0, "IHOT": 0, "NHSTAR": 1, "NHSINC": 43200})
+Fort15Parameters = {}
+
+## MPI ranks per ADCIRC run and number of concurrent runs
+RankNum = 1
+SlotNum = max(1, os.cpu_count() // RankNum)
+
+## Command line of an ADCIRC run ({run_dir} is its folder),
+## e.g. ["mpiexec", "-n", str(RankNum), os.path.join("{run_dir}", "padcirc.exe")]
+AdcircCommand = [os.path.join("{run_dir}", "ADCIRC.exe")]
+
+## Time limit (seconds) and retries of an ADCIRC run
+RunTimeout = 3600 * 6
+RunRetry = 2
+
+######################################## Main Program ###########################################
+
+# Generate input files and control settings for Fujita-Takahashi models ============= #
+
+## Write a text file
+def WriteText(path, text):
+    with open(path, 'w') as text_file:
+        text_file.write(text)
+    return path
+
+## Format the control settings of one run
+def FormatWindSet(reid, startTime, endTime):
     refStartTime = startTime - dt.timedelta(days=dayForward) 
     refEndTime = endTime + dt.timedelta(days=dayBackward)
     
     dayNum = (endTime - startTime).total_seconds() / 3600 / 24 + dayForward + dayBackward
     
-    with open(windset_path, 'w') as windset:
-        if chBool:
-            windset.write("T  0\n")
-            windset.write("StormPath" + reid + ".txt\n")
-        else:
-            windset.write("F  0\n")
+    lines = []
+    if chBool:
+        lines.append("T  0\n")
+        lines.append("StormPath" + reid + ".txt\n")
+    else:
+        lines.append("F  0\n")
+    lines.append(f"{refStartTime.year}  {refStartTime.month}  {refStartTime.day}  {refStartTime.hour}\n")
+    lines.append(f"{refEndTime.year}  {refEndTime.month}  {refEndTime.day}  {refEndTime.hour}\n")
+    lines.append(f"{-dayNum}\n")
+    lines.extend(["1.000\n"] * 3)
+    return "".join(lines), dayNum
+
+## Format StormPath and WindSet texts of all runs from their track records in one pass
+def FormatStormInputs(dfRecord, recordIndex, listREid):
+    bounds = np.array([recordIndex[reid] for reid in listREid], dtype=int).reshape(-1, 2)
+    count = bounds[:, 1] - bounds[:, 0]
+    rows = np.concatenate([np.zeros(0, dtype=int)] + [np.arange(start, stop) for start, stop in bounds])
+    step = np.arange(len(rows)) - np.repeat(np.cumsum(count) - count, count)  # Record number within its run
+    times = pd.DatetimeIndex(np.datetime64(timeStart) + step * np.timedelta64(timeDelt))
     
-        windset.write(f"{refStartTime.year}  {refStartTime.month}  {refStartTime.day}  {refStartTime.hour}\n")
-        windset.write(f"{refEndTime.year}  {refEndTime.month}  {refEndTime.day}  {refEndTime.hour}\n")
-        windset.write(f"{-dayNum}\n")
+    dfFrom = dfRecord.iloc[rows]
+    columns = [np.round(dfFrom["LAT"].to_numpy(dtype=np.float64), 1),  # Round latitude to one decimal place
+               np.round(dfFrom["LONG"].to_numpy(dtype=np.float64), 1),  # Round longitude to one decimal place
+               np.rint(dfFrom["MP"].to_numpy(dtype=np.float64)).astype(int),  # Round central pressure to integer
+               np.rint(dfFrom["MWS"].to_numpy(dtype=np.float64)).astype(int),  # Round maximum wind speed to integer
+               np.full(len(rows), BackgroundPressure),  # Background pressure
+               times.year, times.month, times.day, times.hour]
+    lines = pd.Series(columns[0]).astype(str)
+    for column in columns[1:]:
+        lines = lines + " " + pd.Series(np.asarray(column)).astype(str)
+    lines = (lines + "\n").to_numpy()
     
-        for _ in range(3):
-            windset.write("1.000\n")
-        
-    print(windset_path)
+    listStormPath, listWindSet, listDayNum = [], [], []
+    for reid, first, n in zip(listREid, np.cumsum(count) - count, count):
+        listStormPath.append("".join(lines[first:first + n]))
+        windset, dayNum = FormatWindSet(reid, timeStart, timeStart + timeDelt * (n - 1))
+        listWindSet.append(windset)
+        listDayNum.append(dayNum)
+    return listStormPath, listWindSet, listDayNum
 
 # Generate Fort22 files ============================================================= #
 
-df = pd.read_excel(select_table_path)
-for i in range(len(df)):
-    dfTemp = df.iloc[i]
-    reid = str(dfTemp["REid"])
-        
-    fort22_sub_dir = os.path.join(fort22_dir, reid)
-    fort14_path_out = os.path.join(fort22_sub_dir, "fort.14")
+## Place a shared read-only input into a run folder (hardlink, symlink or copy), return the bytes saved
+def LinkFile(input_path, output_path):
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+    for link in (os.link, os.symlink):
+        try:
+            link(os.path.abspath(input_path), output_path)
+            return os.path.getsize(input_path)
+        except OSError:
+            pass
+    shutil.copy(input_path, output_path)  # Keep the executable bit
+    return 0
+
+## Track of one run at the forcing times (seconds from the model start)
+def InterpolateTrack(dfFrom, times):
+    trackTime = dayForward * 86400 + np.arange(len(dfFrom)) * timeDelt.total_seconds()
+    lon = dfFrom["LONG"].to_numpy(dtype=np.float64)
+    lat = dfFrom["LAT"].to_numpy(dtype=np.float64)
+    if len(dfFrom) > 1:  # Translation velocity (m/s)
+        vx = np.gradient(np.radians(lon) * np.cos(np.radians(lat)) * EarthRadius, trackTime)
+        vy = np.gradient(np.radians(lat) * EarthRadius, trackTime)
+    else:
+        vx = vy = np.zeros(len(dfFrom))
+    columns = {"lon": lon, "lat": lat, "vx": vx, "vy": vy,
+               "pc": dfFrom["MP"].to_numpy(dtype=np.float64) * 100,  # Central pressure (Pa)
+               "vmax": dfFrom["MWS"].to_numpy(dtype=np.float64),  # Maximum wind speed (m/s)
+               "rmw": dfFrom["RMW"].to_numpy(dtype=np.float64) * 1000}  # Radius of maximum wind (m)
+    track = {key: np.interp(times, trackTime, values)[:, None] for key, values in columns.items()}
+    active = (times >= trackTime[0]) & (times <= trackTime[-1])
+    return track, active
+
+## Wind (m/s) and pressure (Pa) at nodes for storm parameters given as columns (times, 1)
+def WindField(lon, lat, track):
+    dx = np.radians(lon - track["lon"]) * np.cos(np.radians(track["lat"])) * EarthRadius
+    dy = np.radians(lat - track["lat"]) * EarthRadius
+    r = np.maximum(np.hypot(dx, dy), 1.0)
+    rmw = np.maximum(track["rmw"], 1000.0)
+    pInf = BackgroundPressure * 100
+    dp = np.maximum(pInf - track["pc"], 0.0)
+    f = 2 * Omega * np.sin(np.radians(lat))
+    
+    if WindModel == "Holland":
+        b = np.clip(AirDensity * np.e * track["vmax"] ** 2 / np.maximum(dp, 1.0), 1.0, 2.5)
+        x = (rmw / r) ** b
+        p = track["pc"] + dp * np.exp(-x)
+        dpdr = dp * b * x * np.exp(-x) / r
+    else:  # Fujita (r < 2R) and Takahashi (r >= 2R) pressure profiles
+        q = r / rmw
+        inner = q < 2
+        p = np.where(inner, pInf - dp / np.sqrt(1 + q ** 2), pInf - dp / (1 + q))
+        dpdr = np.where(inner, dp * q / rmw / (1 + q ** 2) ** 1.5, dp / rmw / (1 + q) ** 2)
     
-    os.mkdir(fort22_sub_dir)
-    shutil.copyfile(fort14_path_in, fort14_path_out)
-    print(fort14_path_out)
+    vg = np.sqrt((f * r / 2) ** 2 + r * dpdr / AirDensity) - np.abs(f) * r / 2  # Gradient wind
+    angle = np.arctan2(dy, dx) + np.radians(InflowAngle)
+    move = MoveCoef * np.exp(-np.pi / 4 * np.abs(r - rmw) / rmw)  # Moving wind
+    u = -GradientCoef * vg * np.sin(angle) + move * track["vx"]
+    v = GradientCoef * vg * np.cos(angle) + move * track["vy"]
+    return u, v, p
+
+## Write fort.22 of one run (NWS = 5: node, wind x/y (m/s), pressure (m of water) every WindInterval)
+def WriteFort22(fort22_path, nodes, dfFrom, dayNum):
+    times = np.arange(0, dayNum * 86400 + 1e-6, WindInterval)
+    track, active = InterpolateTrack(dfFrom, times)
+    lon, lat = nodes[:, 1], nodes[:, 2]
+    nid = nodes[:, 0]
+    step = max(1, ChunkCells // len(nodes))  # Time steps evaluated at a time
+    with open(fort22_path, 'w') as Fort22:
+        for start in range(0, len(times), step):
+            u, v, p = WindField(lon, lat, {key: value[start:start + step] for key, value in track.items()})
+            calm = ~active[start:start + step]
+            u[calm] = 0.0
+            v[calm] = 0.0
+            p[calm] = BackgroundPressure * 100
+            p /= WaterDensity * Gravity
+            for k in range(len(u)):  # One time step at a time, formatted row by row
+                np.savetxt(Fort22, np.column_stack([nid, u[k], v[k], p[k]]), fmt="%d %.4f %.4f %.4f")  # JN WVNX WVNY PRN
 
 # Generate Fort15 files ============================================================= #
 
-def ChangeFort15(input_path, output_path, reid, dayNum):
+## Parse the fort.15 template once, indexing parameter values by the names in their comments
+def ParseFort15(input_path):
     with open(input_path, 'r') as fort15_in:
-        with open(output_path, 'w') as fort15_out:
-            lines = fort15_in.readlines()
-            for i, line in enumerate(lines):
-                tag = (line.split("!"))[-1]
-                if i <= 1:
-                    line = reid + "\n"
-                elif tag == " RNDAY - TOTAL LENGTH OF SIMULATION (IN DAYS)\n":
-                    line = f"{dayNum} !" + tag
-                elif tag == " NOUTE, TOUTSE, TOUTFE, NSPOOLE - FORT 61 OPTIONS\n":
-                    line = f"-1 2.000000 {dayNum-2} 720 !" + tag
-                elif tag == " NOUTGE, TOUTSGE, TOUTFGE, NSPOOLGE - GLOBAL ELEVATION OUTPUT INFO (UNIT 63)\n":
-                    line = f"-1 2.000000 {dayNum-2} 720 !" + tag
-                elif tag == " NOUTGV, TOUTSGV, TOUTFGV, NSPOOLGV - GLOBAL VELOCITY OUTPUT INFO (UNIT 64)\n":
-                    line = f"-1 2.000000 {dayNum-2} 720 !" + tag
-                fort15_out.write(line)
-
-df = pd.read_excel(select_table_path)
-for i in range(len(df)):
-    dfTemp = df.iloc[i]
-    reid = str(dfTemp["REid"])
-     
-    windset_path = os.path.join(windset_dir, "WindSet" + reid + ".txt")   
-    with open(windset_path, 'r') as windset:
-        lines = windset.readlines()
-        dayNum = float(lines[4]) * -1
-    
-    fort15_sub_dir = os.path.join(fort15_dir, reid)
-    fort15_path_out = os.path.join(fort15_sub_dir, "fort.15")
-    
-    os.mkdir(fort15_sub_dir)
-    ChangeFort15(fort15_path_in, fort15_path_out, reid, dayNum)
-    print(fort15_path_out)
+        lines = fort15_in.readlines()
+    values, tags, index = [], [], {"RUNDES": (0, None), "RUNID": (1, None)}  # Whole lines
+    for i, line in enumerate(lines):
+        value, sep, tag = line.partition("!")
+        values.append(value.split())
+        tags.append(sep + tag)
+        if i <= 1 or not sep:
+            continue
+        names = tag.split(" - ")[0].split(",")
+        for j, name in enumerate(names):
+            name = name.strip()
+            if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name) or j >= len(values[i]):
+                break
+            index.setdefault(name, (i, j))
+    return {"lines": lines, "values": values, "tags": tags, "index": index}
+
+## Render a fort.15 text with parameter values replaced by name
+def RenderFort15(template, parameters):
+    changed = {}
+    for name, value in parameters.items():
+        if name not in template["index"]:
+            raise KeyError("Parameter " + name + " not found in fort.15")
+        i, j = template["index"][name]
+        if j is None:
+            changed[i] = str(value) + "\n"
+        else:
+            tokens = changed.setdefault(i, list(template["values"][i]))
+            tokens[j] = str(value)
+    lines = list(template["lines"])
+    for i, tokens in changed.items():
+        lines[i] = tokens if isinstance(tokens, str) else " ".join(tokens) + " " + template["tags"][i]
+    return "".join(lines)
 
 # Batch run ADCIRC programs ========================================================= #
 
-df = pd.read_excel(select_table_path)
-for i in range(len(df)):
-    dfTemp = df.iloc[i]
-    reid = str(dfTemp["REid"])
-    
+## Place a per-run input into its run folder without a second copy (hardlink, else move), return the bytes saved
+def PlaceFile(input_path, output_path):
+    if not os.path.exists(input_path):  # Moved by an earlier staging
+        return 0
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+    try:
+        os.link(input_path, output_path)
+        return os.path.getsize(input_path)
+    except OSError:
+        shutil.move(input_path, output_path)
+        return os.path.getsize(output_path)
+
+## Stage one run: link the shared inputs, place its own fort.15 and fort.22
+def StageRun(reid):
     fort15_sub_dir = os.path.join(fort15_dir, reid)
     fort22_sub_dir = os.path.join(fort22_dir, reid)
     adcirc_sub_dir = os.path.join(adcirc_dir, reid)
-    os.mkdir(adcirc_sub_dir)    
+    os.makedirs(adcirc_sub_dir, exist_ok=True)
+    
+    savedBytes = 0
+    savedBytes += LinkFile(fort13_path_in, os.path.join(adcirc_sub_dir, "fort.13"))
+    savedBytes += LinkFile(fort14_path_in, os.path.join(adcirc_sub_dir, "fort.14"))
+    savedBytes += LinkFile(adcirc_source, os.path.join(adcirc_sub_dir, "ADCIRC.exe"))
+    savedBytes += PlaceFile(os.path.join(fort15_sub_dir, "fort.15"), os.path.join(adcirc_sub_dir, "fort.15"))
+    savedBytes += PlaceFile(os.path.join(fort22_sub_dir, "fort.22"), os.path.join(adcirc_sub_dir, "fort.22"))
+    return adcirc_sub_dir, savedBytes
+
+## Open (or create) the batch state file, recording runs interrupted by a crash as pending
+def OpenState(state_path, listREid):
+    con = sqlite3.connect(state_path, check_same_thread=False)
+    con.execute("""CREATE TABLE IF NOT EXISTS runs (reid TEXT PRIMARY KEY, status TEXT, attempt INTEGER,
+                   returncode INTEGER, start REAL, finish REAL, message TEXT)""")
+    con.executemany("INSERT OR IGNORE INTO runs (reid, status, attempt) VALUES (?, 'pending', 0)",
+                    [(reid,) for reid in listREid])
+    con.execute("UPDATE runs SET status = 'pending' WHERE status = 'running'")
+    con.commit()
+    return con
+
+## Runs recorded as done in the batch state file
+def DoneRuns(con):
+    return {reid for (reid,) in con.execute("SELECT reid FROM runs WHERE status = 'done'")}
+
+## Update the state of one run
+def UpdateState(con, lock, reid, **values):
+    with lock:
+        con.execute("UPDATE runs SET " + ", ".join(key + " = ?" for key in values) + " WHERE reid = ?",
+                    list(values.values()) + [reid])
+        con.commit()
+
+## Run one ADCIRC model, retrying failed or timed-out attempts
+def RunModel(reid, con, lock):
+    adcirc_sub_dir, savedBytes = StageRun(reid)
+    listOutput = [os.path.join(adcirc_sub_dir, "fort.63"), os.path.join(adcirc_sub_dir, "fort.63.nc")]  # ASCII or NetCDF
+    command = [part.format(run_dir=adcirc_sub_dir) for part in AdcircCommand]
+    for _ in range(RunRetry + 1):
+        with lock:
+            con.execute("UPDATE runs SET status = 'running', attempt = attempt + 1, start = ?, finish = NULL,"
+                        " returncode = NULL, message = NULL WHERE reid = ?", (time.time(), reid))
+            con.commit()
+        for output_path in listOutput:
+            if os.path.exists(output_path):
+                os.remove(output_path)  # Output of an earlier attempt
+        
+        message = ""
+        with open(os.path.join(adcirc_sub_dir, "adcirc.log"), 'w') as log:
+            try:
+                returncode = subprocess.run(command, cwd=adcirc_sub_dir, stdout=log, stderr=subprocess.STDOUT,
+                                            timeout=RunTimeout).returncode
+            except subprocess.TimeoutExpired:
+                returncode, message = None, "timeout"
+            except OSError as error:
+                returncode, message = None, str(error)
+        
+        if returncode == 0 and any(os.path.exists(output_path) for output_path in listOutput):
+            UpdateState(con, lock, reid, status="done", returncode=returncode, finish=time.time())
+            return reid, "done", savedBytes
+        if returncode is not None and not message:
+            message = "exit status " + str(returncode) if returncode != 0 else "fort.63 not found"
+        UpdateState(con, lock, reid, status="failed", returncode=returncode, finish=time.time(), message=message)
+    return reid, "failed", savedBytes
+
+## Run all unfinished ADCIRC models in a bounded pool, resuming from the state file
+def RunBatch(listREid, state_path):
+    con = OpenState(state_path, listREid)
+    done = DoneRuns(con)
+    lock = threading.Lock()
+    totalBytes = 0
+    with ThreadPoolExecutor(max_workers=SlotNum) as pool:
+        futures = [pool.submit(RunModel, reid, con, lock) for reid in listREid if reid not in done]
+        for future in as_completed(futures):
+            reid, status, savedBytes = future.result()
+            totalBytes += savedBytes
+            print(os.path.join(adcirc_dir, reid), status)
+    con.close()
+    print(f"Linked inputs saved {totalBytes / 1024 ** 3:.2f} GB")
+
+if __name__ == "__main__":
+
+    ## Generate input files and control settings for Fujita-Takahashi models
+    dfRecord = ReadStore(record_dir)
+    with open(os.path.join(record_dir, "Index.json"), 'r') as index_file:
+        recordIndex = json.load(index_file)
+    
+    df = ReadStore(select_store_dir)
+    listREid = [str(reid) for reid in df["REid"]]
+    listStormPath, listWindSet, listDayNum = FormatStormInputs(dfRecord, recordIndex, listREid)
+    dfRun = pd.DataFrame({"REid": listREid, "dayNum": listDayNum})
     
-    fort15_path_in = os.path.join(fort15_sub_dir, "fort.15")
-    fort22_path_in = os.path.join(fort22_sub_dir, "fort.22")
+    listPath = [os.path.join(format_dir, "StormPath" + reid + ".txt") for reid in listREid]
+    listPath += [os.path.join(windset_dir, "WindSet" + reid + ".txt") for reid in listREid]
+    with ThreadPoolExecutor(max_workers=ThreadNum) as pool:
+        for path in pool.map(WriteText, listPath, listStormPath + listWindSet):
+            print(path)
     
-    fort13_path_out = os.path.join(adcirc_sub_dir, "fort.13")
-    fort14_path_out = os.path.join(adcirc_sub_dir, "fort.14")
-    fort15_path_out = os.path.join(adcirc_sub_dir, "fort.15")
-    fort22_path_out = os.path.join(adcirc_sub_dir, "fort.22")
+    ## Runs finished in an earlier batch are not staged again
+    con = OpenState(state_path, listREid)
+    done = DoneRuns(con)
+    con.close()
+    dfStage = dfRun[~dfRun["REid"].isin(done)]
     
-    target_dir = os.path.join(adcirc_sub_dir, "ADCIRC.exe")
+    ## Generate Fort22 files
+    if WindModel is not None:
+        nodes = LoadMesh(fort14_path_in)["nodes"]  # Node ids, coordinates and depths
     
-    shutil.copyfile(fort13_path_in, fort13_path_out)
-    shutil.copyfile(fort14_path_in, fort14_path_out)
-    shutil.copyfile(fort15_path_in, fort15_path_out)
-    shutil.copyfile(fort22_path_in, fort22_path_out)
-    shutil.copyfile(adcirc_source, target_dir)
+    savedBytes = 0
+    for reid, dayNum in zip(dfStage["REid"], dfStage["dayNum"]):
+        fort22_sub_dir = os.path.join(fort22_dir, reid)
+        os.makedirs(fort22_sub_dir, exist_ok=True)
         
-    os.system(System[:-1] + r" && cd " + adcirc_sub_dir + r" && start ADCIRC.exe")
-    print(target_dir + r"/ADCIRC.exe")
+        if WindModel is None:  # Mesh for the external Fujita-Takahashi program
+            fort14_path_out = os.path.join(fort22_sub_dir, "fort.14")
+            savedBytes += LinkFile(fort14_path_in, fort14_path_out)
+            print(fort14_path_out)
+        else:
+            fort22_path_out = os.path.join(fort22_sub_dir, "fort.22")
+            start, stop = recordIndex[reid]
+            WriteFort22(fort22_path_out, nodes, dfRecord.iloc[start:stop], dayNum)
+            print(fort22_path_out)
+    if WindModel is None:
+        print(f"Linked fort.14 saved {savedBytes / 1024 ** 3:.2f} GB")
+    
+    ## Parameter table of the runs to stage
+    dfFort15 = pd.DataFrame({"RUNDES": dfStage["REid"], "RUNID": dfStage["REid"], "RNDAY": dfStage["dayNum"]})
+    for output in ["E", "GE", "GV"]:  # Fort 61, global elevation(unit 63) and velocity(unit 64) outputs
+        dfFort15["NOUT" + output] = -1
+        dfFort15["TOUTS" + output] = "2.000000"
+        dfFort15["TOUTF" + output] = dfStage["dayNum"] - 2
+        dfFort15["NSPOOL" + output] = 720
+    fort15Template = ParseFort15(fort15_path_in)
+    if WindModel is not None:  # Forcing written by WriteFort22
+        for name in ["NWS", "WTIMINC"]:
+            if name not in fort15Template["index"]:
+                raise KeyError("Parameter " + name + " not found in fort.15, required by the generated fort.22")
+        dfFort15["NWS"] = 5
+        dfFort15["WTIMINC"] = WindInterval
+    for name, value in Fort15Parameters.items():
+        dfFort15[name] = value
+    
+    ## Generate Fort15 files
+    listPath = []
+    for reid in dfStage["REid"]:
+        fort15_sub_dir = os.path.join(fort15_dir, reid)
+        os.makedirs(fort15_sub_dir, exist_ok=True)
+        listPath.append(os.path.join(fort15_sub_dir, "fort.15"))
+    listText = [RenderFort15(fort15Template, parameters) for parameters in dfFort15.to_dict("records")]
+    with ThreadPoolExecutor(max_workers=ThreadNum) as pool:
+        for path in pool.map(WriteText, listPath, listText):
+            print(path)
     
-    if (i + 1) % 8 == 0:
-        time.sleep(3600 * 2)  # Pause for 2 hours every 8 runs
-    print(adcirc_sub_dir)
\ No newline at end of file
+    ## Batch run ADCIRC programs
+    RunBatch(listREid, state_path)
@@ -9,14 +9,68 @@
 # Importing necessary Python packages --------------------------- #
 
 import os
+import time
+import asyncio
+import sqlite3
+import itertools
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from SurgeStore import IsNetCDF, OpenNetCDF, ReadCubeIndex, AppendCube, ReadCube, AnnualMax
+from MeshCache import FileHash, LoadMesh
 
 # Time reference ------------------------------------------------ #
 
 ## Number of years
 YearNum = 250
 
+## Digits of year codes in column names
+YearWidth = max(3, len(str(YearNum - 1)))
+
+# Storm surge settings ------------------------------------------ #
+
+## Stream fort.63 record by record into a running maximum (False writes StormTide.csv/StormSurge.csv)
+StreamSurge = True
+
+## Also record the time of peak surge (seconds from the model start)
+TrackPeak = False
+
+## Also count hours with surge above this level in meters (None to skip)
+SurgeThreshold = None
+
+## ADCIRC value of dry nodes
+DryValue = -99999
+
+## Parallel workers computing surge maxima (StreamSurge only)
+WorkerNum = os.cpu_count()
+
+# Run watching settings ----------------------------------------- #
+
+## Ingest each run as soon as ADCIRC finishes it, while A-2 is still running (StreamSurge only)
+WatchADCIRC = False
+
+## Seconds between polls of the run folders
+PollInterval = 30
+
+## Seconds with an unchanged fort.63 before a run counts as finished (only without the batch state file of A-2)
+StableSeconds = 600
+
+## Stop watching after this many seconds without a finished run (None waits for every run)
+IdleTimeout = None
+
+## Nodes reduced at a time by the annual maximum
+NodeBlock = 100000
+
+## Nodes and runs per block of the surge cube
+CubeNodeChunk = 100000
+CubeRunChunk = 256
+
+## Ranks (0 = smallest) of annual maxima kept by the sort (None sorts all years, as required by A-4)
+SortRanks = None
+
+## Also export MaxSurge.csv (one column per run), MaxSurge_Year.csv and MaxSurge_Sort.csv
+ExportCsv = False
+
 # Input/Output settings ----------------------------------------- #
 
 System = r"A:/"
@@ -29,160 +83,353 @@ adcirc_dir = os.path.join(ModuleA_dir, "ADCIRC")  # Folder for batch running ADC
 surge_dir = os.path.join(ModuleA_dir, "StormSurge")  # Folder for storm surge(total water level - astronomical tide)
 maxsurge_dir = os.path.join(ModuleA_dir, "MaxSurge")  # Folder for annual maximum storm surge
 sort_dir = os.path.join(ModuleA_dir, "Sort")  # Folder for sorted annual maximum storm surge
+store_dir = os.path.join(ModuleA_dir, "Store")  # Folder for columnar stores (one binary file per column)
 
 fort14_path_in = os.path.join(prepare_dir, "fort.14") # Fort14 file
+state_path = os.path.join(adcirc_dir, "BatchState.sqlite") # State of batch running ADCIRC models
 astroTideRef_dir = os.path.join(prepare_dir, "AstronomicalTide_Ref")  # Astronomical tide (ADCIRC input without storms)
 select_table_path = os.path.join(select_dir, "Select_" + str(YearNum) + "yr_buf200km.xlsx") # Selected table records(.xlsx) of TC tracks
 maxsurge_path = os.path.join(maxsurge_dir, "MaxSurge.csv") # Maximum storm surge including all runs
 maxsurge_year_path = os.path.join(maxsurge_dir, "MaxSurge_Year.csv") # Annual maximum storm surge
+maxsurge_year_npy = os.path.join(maxsurge_dir, "MaxSurge_Year.npy") # Annual maximum storm surge (nodes, years)
 sort_path = os.path.join(sort_dir, "MaxSurge_Sort.csv") # Sorted annual maximum storm surge
+sort_npy = os.path.join(sort_dir, "MaxSurge_Sort.npy") # Sorted annual maximum storm surge (nodes, ranks)
+sort_rank_npy = os.path.join(sort_dir, "MaxSurge_Sort_Rank.npy") # Ranks held by the columns of MaxSurge_Sort.npy
+cube_dir = os.path.join(store_dir, "SurgeCube") # Maximum storm surge of all runs in (node chunk, run chunk) blocks
 
 ######################################## Main Program ###########################################
 
 # Calculate storm surge ============================================================= #
 
+## Path of an ADCIRC output, falling back to its NetCDF name (fort.63 -> fort.63.nc)
+def ResolveOutput(output_path):
+    if not os.path.exists(output_path) and os.path.exists(output_path + ".nc"):
+        return output_path + ".nc"
+    return output_path
+
+## Read the number of records, number of nodes and output interval(s) from the header of fort.63
+def ReadFort63Meta(Fort63):
+    Fort63.readline()
+    meta = Fort63.readline().split()
+    return int(meta[0]), int(meta[1]), float(meta[2])
+
+## Number of records, number of nodes and output interval(s) of fort.63, ASCII or NetCDF
+def Fort63Meta(fort63_path):
+    fort63_path = ResolveOutput(fort63_path)
+    if IsNetCDF(fort63_path):
+        with OpenNetCDF(fort63_path) as dataset:
+            recordNum, nodeNum = dataset.variables["zeta"].shape
+            times = np.array(dataset.variables["time"][:2], dtype=np.float64)
+        return recordNum, nodeNum, float(times[1] - times[0]) if len(times) > 1 else 0.0
+    with open(fort63_path, 'r') as Fort63:
+        return ReadFort63Meta(Fort63)
+
+## Yield (time, values) of fort.63 one record at a time, read lazily from NetCDF or parsed in bulk from ASCII
+def IterFort63(fort63_path, dtype=np.float32, nodeRange=None):
+    fort63_path = ResolveOutput(fort63_path)
+    nodeSlice = slice(*nodeRange) if nodeRange else slice(None)
+    if IsNetCDF(fort63_path):
+        with OpenNetCDF(fort63_path) as dataset:
+            zeta, times = dataset.variables["zeta"], dataset.variables["time"]
+            for i in range(zeta.shape[0]):
+                yield float(times[i]), np.array(zeta[i, nodeSlice], dtype=dtype)
+            del zeta, times  # Release the mapped data before closing
+        return
+    with open(fort63_path, 'r') as Fort63:
+        recordNum, nodeNum, _ = ReadFort63Meta(Fort63)
+        for i in range(recordNum):
+            head = Fort63.readline().split()
+            if not head:  # Run stopped before writing all records, e.g. timed out in A-2
+                raise ValueError(f"{fort63_path} holds {i} of {recordNum} records")
+            if len(head) > 2:  # Sparse record: time, step, number of listed nodes, default value
+                lineNum = int(head[2])
+                values = np.full(nodeNum, float(head[3]), dtype=dtype)
+            else:
+                lineNum = nodeNum
+                values = np.empty(nodeNum, dtype=dtype)
+            block = np.fromstring("".join(itertools.islice(Fort63, lineNum)), sep=" ").reshape(lineNum, 2)
+            values[block[:, 0].astype(np.int64) - 1] = block[:, 1]
+            yield float(head[0]), values[nodeSlice]
+
+## Read fort.63 (or a node range of it) into a (records, nodes) array
+def ReadFort63(fort63_path, dtype=np.float32, nodeRange=None):
+    recordNum, nodeNum, _ = Fort63Meta(fort63_path)
+    nodeStart, nodeStop = nodeRange or (0, nodeNum)
+    array = np.empty((recordNum, nodeStop - nodeStart), dtype=dtype)
+    for i, (_, values) in enumerate(IterFort63(fort63_path, dtype, nodeRange)):
+        array[i] = values
+    return array
+
 ## Convert Fort.63 to CSV file
 def RewriteFort63(fort63_path, output_path):
-    Header = ["NID"]
-    Fort63 = open(fort63_path) 
-    lines63 = Fort63.readlines()
+    array = ReadFort63(fort63_path, np.float64)
+    df = pd.DataFrame(array.T, columns=["t" + str(1001 + i)[-3:] for i in range(len(array))])
+    df.insert(loc=0, column="NID", value=np.arange(1, array.shape[1] + 1))
+    df.to_csv(output_path, index=False)
+
+## Running maximum storm surge of one run, subtracting the matching astronomical tide record by record
+def StreamSurgeMax(fort63_path, astroTide, threshold=None, peak=False):
+    recordNum, nodeNum, interval = Fort63Meta(fort63_path)
+    maxele = np.zeros(nodeNum, dtype=np.float32)  # Floored at zero like the maxele column of StormSurge.csv
+    peakTime = np.full(nodeNum, np.nan, dtype=np.float32) if peak else None
+    hours = np.zeros(nodeNum, dtype=np.float32) if threshold is not None else None
+    surge = np.empty(nodeNum, dtype=np.float32)
+    for i, (stamp, values) in enumerate(IterFort63(fort63_path)):
+        np.subtract(values, astroTide[i], out=surge)
+        surge[(values <= DryValue) | (astroTide[i] <= DryValue)] = -np.inf  # Dry in the storm run or the tide reference
+        if peak:
+            peakTime[surge > maxele] = stamp
+        np.maximum(maxele, surge, out=maxele)
+        if threshold is not None:
+            hours[surge > threshold] += interval / 3600
+    return maxele, peakTime, hours
+
+## Parse the astronomical tide once into a .npy cache keyed by its content hash, then memory-map it
+def LoadAstroTide(fort63_path, cache_dir):
+    fort63_path = ResolveOutput(fort63_path)
+    cache_path = os.path.join(cache_dir, "AstroTide_" + FileHash(fort63_path)[:16] + ".npy")
+    if not os.path.exists(cache_path):
+        temp_path = cache_path + ".tmp"
+        with open(temp_path, 'wb') as Cache:
+            np.save(Cache, ReadFort63(fort63_path))
+        os.replace(temp_path, cache_path)  # Readers never see a partial cache
+    return np.load(cache_path, mmap_mode="r")  # Shared through the page cache by every process
+
+## Surge maxima of one run, keeping only the per-node results
+def SurgeRun(reid, astroTide):
+    fort63_path = os.path.join(adcirc_dir, reid, "fort.63")
+    surge_sub_dir = os.path.join(surge_dir, reid)
+    os.makedirs(surge_sub_dir, exist_ok=True)
+    maxele, peakTime, hours = StreamSurgeMax(fort63_path, astroTide, SurgeThreshold, TrackPeak)
+    if peakTime is not None:
+        np.save(os.path.join(surge_sub_dir, "PeakTime.npy"), peakTime)
+    if hours is not None:
+        np.save(os.path.join(surge_sub_dir, "HoursAbove.npy"), hours)
+    np.save(os.path.join(surge_sub_dir, "maxele.npy"), maxele)  # Last, marks the run as processed
+    return surge_sub_dir
+
+## Surge maxima of one run in a worker process, mapping the astronomical tide cache
+def SurgeRunWorker(reid, cache_path):
+    return SurgeRun(reid, np.load(cache_path, mmap_mode="r"))
+
+## Surge maxima of the given runs in a worker pool, returning the runs that failed
+def SurgeRuns(listREid, cache_path):
+    listFailed = []
+    with ProcessPoolExecutor(max_workers=WorkerNum) as pool:
+        futures = [pool.submit(SurgeRunWorker, reid, cache_path) for reid in listREid]
+        for reid, future in zip(listREid, futures):
+            try:
+                print(future.result())
+            except Exception as error:  # One unreadable fort.63 must not stop the other runs
+                listFailed.append(reid)
+                print(f"Failed {reid}: {error!r}")
+    return listFailed
+
+# Ingest runs as they finish ======================================================== #
+
+## Status and finish time of every run in the batch state file of A-2 (empty without the file)
+def ReadRunStatus():
+    if not os.path.exists(state_path):
+        return {}
+    con = sqlite3.connect(state_path, timeout=60)
+    status = {reid: (value, finish) for reid, value, finish in con.execute("SELECT reid, status, finish FROM runs")}
+    con.close()
+    return status
+
+## Runs finished so far with their finish times: "done" in the batch state file of A-2, otherwise fort.63 unchanged for StableSeconds
+def PollFinished(listREid, sizes):
+    if os.path.exists(state_path):
+        status = ReadRunStatus()
+        closed = all(status.get(reid, (None,))[0] in ("done", "failed") for reid in listREid)  # Nothing left to wait for
+        return {reid: status[reid][1] for reid in listREid if status.get(reid, (None,))[0] == "done"}, closed
+    finished = {}
+    now = time.time()
+    for reid in listREid:
+        fort63_path = ResolveOutput(os.path.join(adcirc_dir, reid, "fort.63"))
+        if not os.path.exists(fort63_path):
+            continue
+        stat = os.stat(fort63_path)
+        if sizes.get(reid, (None,))[0] != stat.st_size:
+            sizes[reid] = (stat.st_size, now)
+        elif now - max(sizes[reid][1], stat.st_mtime) >= StableSeconds:
+            finished[reid] = stat.st_mtime  # Last write of ADCIRC
+    return finished, False
+
+## Hand each run to the worker pool as soon as it finishes, appending results to the surge cube
+async def WatchRuns(listREid, cache_path):
+    loop = asyncio.get_running_loop()
+    listWait = [reid for reid in listREid if not os.path.exists(os.path.join(surge_dir, reid, "maxele.npy"))]
+    running, listDone, listFailed, sizes = {}, [], [], {}
+    lastFinish = time.time()
+    with ProcessPoolExecutor(max_workers=WorkerNum) as pool:
+        while listWait or running:
+            finished, closed = PollFinished(listWait, sizes)
+            for reid, finish in finished.items():
+                listWait.remove(reid)
+                running[loop.run_in_executor(pool, SurgeRunWorker, reid, cache_path)] = (reid, finish or time.time())
+            if running:
+                done, _ = await asyncio.wait(running, timeout=PollInterval, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                done = set()
+                await asyncio.sleep(PollInterval)
+            for future in done:
+                reid, finish = running.pop(future)
+                lastFinish = time.time()
+                try:
+                    surge_sub_dir = future.result()
+                except Exception as error:  # One unreadable fort.63 must not stop the other runs
+                    listFailed.append(reid)
+                    print(f"Failed {reid}: {error!r}")
+                    continue
+                listDone.append(reid)
+                print(f"{surge_sub_dir} latency {lastFinish - finish:.1f}s since ADCIRC finished, running {len(running)}, waiting {len(listWait)}")
+            if len(listDone) >= CubeRunChunk:
+                AppendCube(cube_dir, np.column_stack([np.load(os.path.join(surge_dir, reid, "maxele.npy")) for reid in listDone]), listDone,
+                           CubeNodeChunk, CubeRunChunk)
+                listDone = []
+            if not running and (closed or (IdleTimeout is not None and time.time() - lastFinish > IdleTimeout)):
+                break
+    if listWait:
+        print("Not finished:", listWait)
+    return listFailed
+
+# Calculate annual maximum storm surge ============================================== #
+
+## Export a (nodes, columns) matrix to CSV with a NID column, one node block at a time
+def ExportMatrixCsv(matrix, columns, output_path):
+    for start in range(0, len(matrix), NodeBlock):
+        df = pd.DataFrame(matrix[start:start + NodeBlock], columns=columns)
+        df.insert(loc=0, column="NID", value=np.arange(start + 1, start + len(df) + 1))
+        df.to_csv(output_path, index=False, header=start == 0, mode='w' if start == 0 else 'a')
+
+# Sort annual maximum storm surge =================================================== #
+
+## Sort annual maxima of each node, or select only the given ranks
+def SortAnnualMax(block, listRank=None):
+    if listRank is None:
+        return np.sort(block, axis=1)
+    return np.partition(block, listRank, axis=1)[:, listRank]
+
+if __name__ == "__main__":
+
+    ## Calculate storm surge
+    astrotide_path_fort63 = os.path.join(astroTideRef_dir, "fort.63")
+    astrotide_path_csv = os.path.join(astroTideRef_dir, "AstroTide.csv")
+    df = pd.read_excel(select_table_path)
+    listREid = [str(reid) for reid in df["REid"]]
     
-    meta = lines63[1].split() 
-    recordNum = int(meta[0])  # Number of records
-    nodeNum = int(meta[1])  # Number of nodes
+    ## Only runs neither in the cube nor processed by an earlier invocation
+    index = ReadCubeIndex(cube_dir)
+    setDone = set() if index is None else set(index["runs"])
+    result_name = "maxele.npy" if StreamSurge else "StormSurge.csv"
+    listNew = [reid for reid in listREid if reid not in setDone]
+    listTodo = [reid for reid in listNew if not os.path.exists(os.path.join(surge_dir, reid, result_name))]
+    status = ReadRunStatus()
+    listFailed = [reid for reid in listTodo if status.get(reid, (None,))[0] == "failed"]  # Partial fort.63 of failed runs
+    if listFailed:
+        print("Warning: runs failed in A-2 left out:", listFailed)
+        listTodo = [reid for reid in listTodo if reid not in listFailed]
     
-    array = np.empty((recordNum+1, nodeNum+1))
-    fort63List = []
-      
-    for i in range(recordNum):
-        timeID = "t" + str(1001 + i)[-3:]
-        Header.append(timeID)    
+    if StreamSurge and listTodo:
+        astroTide = LoadAstroTide(astrotide_path_fort63, astroTideRef_dir)
+        if WatchADCIRC:
+            listFailed = asyncio.run(WatchRuns(listTodo, astroTide.filename))
+        else:
+            listFailed = SurgeRuns(listTodo, astroTide.filename)
+        if listFailed:
+            print("Failed runs:", listFailed)
+    elif listTodo:
+        RewriteFort63(astrotide_path_fort63, astrotide_path_csv)
+        df_at_all = pd.read_csv(astrotide_path_csv)  # Parsed once for all runs
         
-        tempList = []
+        for reid in listTodo:
+            adcirc_sub_dir = os.path.join(adcirc_dir, reid)
+            fort63_path = os.path.join(adcirc_sub_dir, "fort.63")    
         
-        for j in range(1, nodeNum + 1):
-            temp = lines63[2 + (nodeNum + 1) * i + j].split() 
-            array[i][j] = temp[1] 
-            temp = float(temp[1]) 
-            tempList.append(temp)
-    
-        fort63List.append(tempList)
+            surge_sub_dir = os.path.join(surge_dir, reid)
+            os.makedirs(surge_sub_dir, exist_ok=True)
+            stormtide_path = os.path.join(surge_sub_dir, "StormTide.csv")
+            stormsurge_path = os.path.join(surge_sub_dir, "StormSurge.csv")
         
-    fort63List = list(map(list, zip(*fort63List)))
+            try:
+                RewriteFort63(fort63_path, stormtide_path)
+            except ValueError as error:  # One unreadable fort.63 must not stop the other runs
+                print(f"Failed {reid}: {error!r}")
+                continue
+     
+            df_wl = pd.read_csv(stormtide_path)
+            df_at = df_at_all[df_wl.columns]
     
-    List = []
-    for i in range(nodeNum):
-        temp = [i + 1]
-        temp.extend(fort63List[i])
-        List.append(temp)
+            df_ss = df_wl - df_at
+            df_ss["maxele"] = df_ss.max(axis=1)  # Extract the maximum value
+            df_ss["NID"] = df_wl["NID"]
         
-    df = pd.DataFrame(List)
-    df.to_csv(output_path, header=Header, index=False)
-
-## Calculate storm surge
-astrotide_path_fort63 = os.path.join(astroTideRef_dir, "fort.63")
-astrotide_path_csv = os.path.join(astroTideRef_dir, "AstroTide.csv")
-RewriteFort63(astrotide_path_fort63, astrotide_path_csv)
-
-df = pd.read_excel(select_table_path)
-for i in range(len(df)):
-    dfTemp = df.iloc[i]
-    reid = str(dfTemp["REid"])
-    
-    adcirc_sub_dir = os.path.join(adcirc_dir, reid)
-    fort63_path = os.path.join(adcirc_sub_dir, "fort.63")    
-    
-    surge_sub_dir = os.path.join(surge_dir, reid)
-    os.mkdir(surge_sub_dir)
-    stormtide_path = os.path.join(surge_sub_dir, "StormTide.csv")
-    stormsurge_path = os.path.join(surge_sub_dir, "StormSurge.csv")
-    
-    RewriteFort63(fort63_path, stormtide_path)
- 
-    df_wl = pd.read_csv(stormtide_path)
-    df_at = pd.read_csv(astrotide_path_csv, usecols=df_wl.columns)
-
-    df_ss = df_wl - df_at
-    df_ss["maxele"] = df_ss.max(axis=1)  # Extract the maximum value
-    df_ss["NID"] = df_wl["NID"]
-    
-    Header = list(df_wl.columns)
-    Header.append("maxele")
-    df_ss.to_csv(stormsurge_path, header=Header, index=False)
+            Header = list(df_wl.columns)
+            Header.append("maxele")
+            df_ss.to_csv(stormsurge_path, header=Header, index=False)
+        
+            print(stormsurge_path)
     
-    print(stormsurge_path)   
-
-# Calculate annual maximum storm surge ============================================== #
-
-## Calculate maximum storm surge for each run
-df_ss = pd.DataFrame()
-df_mss = pd.DataFrame()
-
-df = pd.read_excel(select_table_path)
-Header = []
-
-for i in range(len(df)):
+    ## Append maximum storm surge of runs not yet in the cube, leaving out runs without results
+    index = ReadCubeIndex(cube_dir)
+    setDone = set() if index is None else set(index["runs"])
+    listNew = [reid for reid in listREid if reid not in setDone]
+    listMissing = [reid for reid in listNew if not os.path.exists(os.path.join(surge_dir, reid, result_name))]
+    if listMissing:
+        print(f"Warning: {len(listMissing)} runs without {result_name} left out of the cube:", listMissing)
+        listNew = [reid for reid in listNew if reid not in listMissing]
     
-    dfTemp = df.iloc[i]
-    tcid = str(dfTemp["TCid"])
-    reid = str(dfTemp["REid"])
+    for start in range(0, len(listNew), CubeRunChunk):
+        listMaxele = []
+        for reid in listNew[start:start + CubeRunChunk]:
+            surge_sub_dir = os.path.join(surge_dir, reid)
+            stormsurge_path = os.path.join(surge_sub_dir, "StormSurge.csv")
+            if StreamSurge:
+                listMaxele.append(np.load(os.path.join(surge_sub_dir, "maxele.npy")))
+            else:
+                listMaxele.append(pd.read_csv(stormsurge_path, usecols=["maxele"])["maxele"].to_numpy())
+            print(reid)
+        index = AppendCube(cube_dir, np.column_stack(listMaxele), listNew[start:start + CubeRunChunk], CubeNodeChunk, CubeRunChunk)
+    nodeNum = index["nodes"]
     
-    Header.append(reid)
-   
-    surge_sub_dir = os.path.join(surge_dir, reid)
-    stormsurge_path = os.path.join(surge_sub_dir, "StormSurge.csv")    
-          
-    df_ss = pd.read_csv(stormsurge_path)
-    df_mss[reid] = df_ss['maxele']
+    ## Annual maxima only over runs in the cube
+    inCube = df["REid"].astype(str).isin(index["runs"]).to_numpy()
+    if not inCube.all():
+        print(f"Warning: {(~inCube).sum()} runs missing from the cube left out of the annual maxima")
+    listREid = [reid for reid, keep in zip(listREid, inCube) if keep]
+    listYear = df["Year"].to_numpy()[inCube]
+    mesh = LoadMesh(fort14_path_in)
+    if len(mesh["nodes"]) != nodeNum:
+        raise ValueError(f"Mesh has {len(mesh['nodes'])} nodes, cube has {nodeNum}")
     
-    print(reid)
-
-df_mss["maxele"] = df_mss.max(axis=1)  # Extract the maximum value
-df_mss["NID"] = df_ss["NID"]
-df_mss.to_csv(maxsurge_path, index=False)
-print(maxsurge_path)
-
-## Calculate annual maximum surge
-df_mss_year = pd.DataFrame()
-df_mss_year["NID"] = df_mss["NID"]
-
-df = pd.read_excel(select_table_path)
-for year in range(YearNum):
-    listYear = []
-    dfYear = df[df["Year"] == year]
-    if len(dfYear) > 0:
-        listTC = list(dfYear["REid"])
-        print(listTC)
-        for i in range(len(df_mss)):
-            listMax = []
-            dfTemp = df_mss.iloc[i]
-            for tcid in listTC:
-                listMax.append(float(dfTemp[reid]))
-            listYear.append(max(listMax))
-    else:
-        listYear = [0] * len(df_mss)
+    ## Maximum storm surge over all runs
+    if ExportCsv:
+        df_mss = pd.DataFrame(ReadCube(cube_dir, listREid=listREid, index=index), columns=listREid)
+        df_mss["maxele"] = df_mss.max(axis=1)  # Extract the maximum value
+        df_mss["NID"] = mesh["nodes"][:, 0].astype(np.int64)
+        df_mss.to_csv(maxsurge_path, index=False)
+        print(maxsurge_path)
     
-    df_mss_year["Year" + str(1000 + year)[-3:]] = listYear
-df_mss_year.to_csv(maxsurge_year_path, index=False)
-print(maxsurge_year_path)
-
-# Sort annual maximum storm surge =================================================== #
-
-df_sort = pd.DataFrame()
-
-df_mss_year = pd.read_csv(maxsurge_year_path)
-listNID = df_mss_year["NID"]
-df_mss_year = df_mss_year.drop("NID", axis=1)
-listSort = []
-
-for i in range(len(df_mss_year)):
-    dfTemp = df_mss_year.iloc[i]
-    listTemp = sorted(list(dfTemp))
-    listSort.append(listTemp)
-    print(i)
+    ## Calculate annual maximum surge
+    annual = np.lib.format.open_memmap(maxsurge_year_npy, mode="w+", dtype=index["dtype"], shape=(nodeNum, YearNum))
+    for start in range(0, nodeNum, NodeBlock):
+        stop = min(start + NodeBlock, nodeNum)
+        annual[start:stop] = AnnualMax(ReadCube(cube_dir, (start, stop), listREid, index), listYear, YearNum, NodeBlock)
+    annual.flush()
+    print(maxsurge_year_npy)
+    if ExportCsv:
+        ExportMatrixCsv(annual, ["Year" + str(year).zfill(YearWidth) for year in range(YearNum)], maxsurge_year_path)
+        print(maxsurge_year_path)
     
-listHeader = ["Sort" + str(1000 + j)[-3:] for j in range(YearNum)]
-df_sort = pd.DataFrame(listSort, columns=listHeader)
-df_sort.insert(loc=0, column='NID', value=listNID)
-df_sort["NID"] = listNID 
-df_sort.to_csv(sort_path, index=False)
\ No newline at end of file
+    ## Sort annual maximum storm surge
+    listRank = list(range(YearNum)) if SortRanks is None else sorted(SortRanks)
+    annual = np.load(maxsurge_year_npy, mmap_mode="r")
+    sort = np.lib.format.open_memmap(sort_npy, mode="w+", dtype=annual.dtype, shape=(nodeNum, len(listRank)))
+    for start in range(0, nodeNum, NodeBlock):  # Bounded memory for meshes larger than RAM
+        sort[start:start + NodeBlock] = SortAnnualMax(annual[start:start + NodeBlock], None if SortRanks is None else listRank)
+    sort.flush()
+    np.save(sort_rank_npy, np.array(listRank))
+    print(sort_npy)
+    if ExportCsv:
+        ExportMatrixCsv(sort, ["Sort" + str(rank).zfill(YearWidth) for rank in listRank], sort_path)
+        print(sort_path)
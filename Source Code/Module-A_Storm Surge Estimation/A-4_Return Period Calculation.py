@@ -11,13 +11,58 @@
 import os
 import pandas as pd
 import numpy as np
-from scipy import stats
+from scipy import stats, special
+from concurrent.futures import ProcessPoolExecutor
+from SurgeStore import ReadCubeIndex, ReadCube, AnnualMax
+from MeshCache import LoadMesh
 
 # Time reference ------------------------------------------------ #
 
 ## Number of years
 YearNum = 250
 
+# Surge source settings ----------------------------------------- #
+
+## Read annual maxima from the surge cube of A-3 ("Cube") or from MaxSurge_Sort.npy sorted over all years ("Sort")
+SurgeSource = "Cube"
+
+## Nodes read from the surge cube at a time
+NodeBlock = 100000
+
+# GEV fitting settings ------------------------------------------ #
+
+## Estimator: "PWM" (closed-form probability-weighted moments) or "MLE" (PWM refined by damped Newton steps)
+GevMethod = "MLE"
+
+## Newton steps of the MLE refinement
+MleSteps = 50
+
+## Nodes fitted per task
+FitBlock = 10000
+
+## Fewest years with nonzero annual maxima for a GEV fit (nodes with fewer are masked)
+MinWetYears = 10
+
+## Return levels, GEV parameters and p-value of masked nodes that cannot be fitted (dry value of ADCIRC outputs)
+MaskValue = -99999.0
+
+## Parallel workers fitting node blocks
+WorkerNum = os.cpu_count()
+
+# Bootstrap settings -------------------------------------------- #
+
+## Bootstrap replicates for confidence bands of return levels (0 to skip)
+BootstrapNum = 200
+
+## Replicates fitted per task
+ReplicateBlock = 25
+
+## Confidence level of the bands
+Confidence = 0.90
+
+## Seed of the bootstrap random streams (one stream per replicate)
+BootstrapSeed = 20240618
+
 # Spatial reference --------------------------------------------- #
 
 ## Geographic coordinate system
@@ -44,39 +89,163 @@ select_dir = os.path.join(ModuleA_dir, "Select")  # Folder for selected landfall
 sort_dir = os.path.join(ModuleA_dir, "Sort")  # Folder for sorted annual maximum storm surge
 gev_dir = os.path.join(ModuleA_dir, "GEV")  # Folder for GEV fittings
 return_dir = os.path.join(ModuleA_dir, "ReturnPeriod")  # Folder for return periods
+store_dir = os.path.join(ModuleA_dir, "Store")  # Folder for columnar stores (one binary file per column)
 
 fort14_path_in = os.path.join(prepare_dir, "fort.14") # Fort14 file
 select_table_path = os.path.join(select_dir, "Select_" + str(YearNum) + "yr_buf200km.xlsx") # Selected table records(.xlsx) of TC tracks
-sort_path = os.path.join(sort_dir, "MaxSurge_Sort.csv") # Sorted annual maximum storm surge
+sort_npy = os.path.join(sort_dir, "MaxSurge_Sort.npy") # Sorted annual maximum storm surge (nodes, ranks)
+sort_rank_npy = os.path.join(sort_dir, "MaxSurge_Sort_Rank.npy") # Ranks held by the columns of MaxSurge_Sort.npy
 gev_path = os.path.join(gev_dir, "MaxSurge_GEV.csv") # GEV fittings
+mask_path = os.path.join(gev_dir, "NodeMask.npy") # Node classes of the GEV fittings (nodes,)
 return_path = os.path.join(return_dir, "ReturnPeriod_NID.csv") # Return periods sorted by NID
+cube_dir = os.path.join(store_dir, "SurgeCube") # Maximum storm surge of all runs in (node chunk, run chunk) blocks
 
 # Global Constants ---------------------------------------------- #
 
 ## List of return periods
 listReturnPeriod = [10, 20, 50, 100]
 
+## Node classes of the GEV mask: fitted, all zero, constant, too few nonzero years
+NodeFit, NodeDry, NodeConstant, NodeSparse = 0, 1, 2, 3
+
 ######################################## Main Program ###########################################
 
 # GEV fittings ====================================================================== #
 
-df_sort = pd.read_csv(sort_path)
-listNID = df_sort["NID"]
-df_sort = df_sort.drop("NID", axis=1)
-
-listARG = [] 
-for i in range(len(df_sort)):
-    dfTemp = df_sort.iloc[i]
-    args = stats.genextreme.fit(list(dfTemp))
-    listTemp = list(args)
-    ks = stats.kstest(list(dfTemp), 'genextreme', args)
-    listTemp.append(ks[1])
-    listARG.append(listTemp)
-    print(i)
-    
-df_arg = pd.DataFrame(listARG, columns=["Shape", "Location", "Scale", "P-value"])
-df_arg.insert(loc=0, column='NID', value=listNID)
-df_arg.to_csv(gev_path, index=False)
+## Annual maxima of all nodes, one node block at a time
+def IterAnnualMax():
+    if SurgeSource == "Cube":
+        df = pd.read_excel(select_table_path)
+        index = ReadCubeIndex(cube_dir)
+        inCube = df["REid"].astype(str).isin(index["runs"]).to_numpy()
+        if not inCube.all():
+            print(f"Warning: {(~inCube).sum()} runs missing from the cube left out of the annual maxima")
+        df = df[inCube]
+        listREid = [str(reid) for reid in df["REid"]]
+        for start in range(0, index["nodes"], NodeBlock):
+            stop = min(start + NodeBlock, index["nodes"])
+            yield AnnualMax(ReadCube(cube_dir, (start, stop), listREid, index), df["Year"].to_numpy(), YearNum, NodeBlock)
+    else:
+        ## A partial sort (SortRanks of A-3) is not a sample of annual maxima
+        listRank = np.load(sort_rank_npy).tolist() if os.path.exists(sort_rank_npy) else None
+        if listRank != list(range(YearNum)):
+            raise ValueError(sort_npy + " does not hold all " + str(YearNum) + " years, rerun A-3 with SortRanks = None")
+        sort = np.load(sort_npy, mmap_mode="r")
+        for start in range(0, len(sort), NodeBlock):
+            yield sort[start:start + NodeBlock]
+
+## GEV log-density in the scipy convention (shape c, location, scale), for samples (nodes, n) and parameters (nodes, 1)
+def GevLogPdf(x, c, loc, scale):
+    with np.errstate(all="ignore"):
+        z = (x - loc) / scale
+        gumbel = np.abs(c) < 1e-8
+        cSafe = np.where(gumbel, 1.0, c)
+        logy = np.log1p(-cSafe * z)
+        logPdf = np.where(gumbel, -z - np.exp(-z), (1 / cSafe - 1) * logy - np.exp(logy / cSafe)) - np.log(scale)
+    return np.where(np.isnan(logPdf), -np.inf, logPdf)  # Outside the support
+
+## GEV cumulative distribution in the scipy convention
+def GevCdf(x, c, loc, scale):
+    with np.errstate(all="ignore"):
+        z = (x - loc) / scale
+        gumbel = np.abs(c) < 1e-8
+        cSafe = np.where(gumbel, 1.0, c)
+        y = np.maximum(1 - cSafe * z, 0)
+        return np.where(gumbel, np.exp(-np.exp(-z)), np.exp(-y ** (1 / cSafe)))
+
+## Closed-form GEV estimates of sorted samples (nodes, n) from probability-weighted moments (Hosking et al., 1985)
+def FitGevPwm(sample):
+    n = sample.shape[1]
+    j = np.arange(n)
+    b0 = sample.mean(axis=1)
+    b1 = sample @ (j / (n - 1)) / n
+    b2 = sample @ (j * (j - 1) / ((n - 1) * (n - 2))) / n
+    l1, l2, l3 = b0, 2 * b1 - b0, 6 * b2 - 6 * b1 + b0  # L-moments
+    with np.errstate(all="ignore"):
+        z = 2 / (3 + l3 / l2) - np.log(2) / np.log(3)
+        c = 7.8590 * z + 2.9554 * z ** 2
+        gumbel = np.abs(c) < 1e-8
+        cSafe = np.where(gumbel, 1.0, c)
+        gamma = special.gamma(1 + cSafe)
+        scale = np.where(gumbel, l2 / np.log(2), l2 * cSafe / ((1 - 2 ** -cSafe) * gamma))
+        loc = np.where(gumbel, l1 - np.euler_gamma * scale, l1 - scale * (1 - gamma) / cSafe)
+    return c, loc, scale
+
+## Log-likelihood of each node for parameters theta (nodes, 3) = (shape, location, log scale)
+def GevLogLik(sample, theta):
+    return GevLogPdf(sample, theta[:, :1], theta[:, 1:2], np.exp(theta[:, 2:])).sum(axis=1)
+
+## Refine GEV estimates to maximum likelihood by damped Newton steps on all nodes at once
+def FitGevMle(sample, c, loc, scale, steps=MleSteps):
+    theta = np.column_stack([c, loc, np.log(scale)])
+    logLik = GevLogLik(sample, theta)
+    outside = ~np.isfinite(logLik) & np.isfinite(theta).all(axis=1)  # Sample beyond the PWM support: start from Gumbel
+    theta[outside, 0] = 0.0
+    logLik[outside] = GevLogLik(sample[outside], theta[outside])
+    damping = np.full(len(theta), 1e-3)
+    active = np.isfinite(logLik)
+    for _ in range(steps):
+        index = np.flatnonzero(active)
+        if len(index) == 0:
+            break
+        t, x, f0 = theta[index], sample[index], logLik[index]
+        h = 1e-4 * np.column_stack([np.ones(len(t)), np.exp(t[:, 2]), np.ones(len(t))])  # Finite-difference steps
+        shift = [np.zeros_like(t) for _ in range(3)]
+        for i in range(3):
+            shift[i][:, i] = h[:, i]
+        fPlus = np.column_stack([GevLogLik(x, t + shift[i]) for i in range(3)])
+        fMinus = np.column_stack([GevLogLik(x, t - shift[i]) for i in range(3)])
+        grad = (fPlus - fMinus) / (2 * h)
+        hess = np.empty((len(t), 3, 3))
+        for i in range(3):
+            hess[:, i, i] = (fPlus[:, i] - 2 * f0 + fMinus[:, i]) / h[:, i] ** 2
+            for k in range(i + 1, 3):
+                cross = (GevLogLik(x, t + shift[i] + shift[k]) - GevLogLik(x, t + shift[i] - shift[k])
+                         - GevLogLik(x, t - shift[i] + shift[k]) + GevLogLik(x, t - shift[i] - shift[k]))
+                hess[:, i, k] = hess[:, k, i] = cross / (4 * h[:, i] * h[:, k])
+        with np.errstate(all="ignore"):  # Levenberg-Marquardt damping keeps each step uphill
+            system = -hess + (damping[index, None] * np.abs(np.diagonal(hess, axis1=1, axis2=2)) + 1e-12)[:, :, None] * np.eye(3)
+            delta = np.linalg.solve(system, grad[:, :, None])[:, :, 0]
+        fNew = GevLogLik(x, t + delta)
+        better = np.isfinite(fNew) & (fNew > f0)
+        theta[index[better]] = (t + delta)[better]
+        logLik[index[better]] = fNew[better]
+        damping[index] = np.where(better, damping[index] / 10, damping[index] * 10)
+        active[index[((grad * delta).sum(axis=1) < 1e-9) | (damping[index] > 1e10)]] = False  # Converged
+    return theta[:, 0], theta[:, 1], np.exp(theta[:, 2])
+
+## Kolmogorov-Smirnov p-values of sorted samples (nodes, n) against the fitted GEV distributions
+def KsPvalue(sample, c, loc, scale):
+    n = sample.shape[1]
+    cdf = GevCdf(sample, c[:, None], loc[:, None], scale[:, None])
+    i = np.arange(1, n + 1)
+    d = np.maximum((i / n - cdf).max(axis=1), (cdf - (i - 1) / n).max(axis=1))
+    return stats.kstwo.sf(d, n)
+
+## Classify the annual maxima (nodes, years) of each node before fitting
+def ClassifyNodes(annual):
+    wetNum = np.count_nonzero(annual, axis=1)
+    nodeClass = np.full(len(annual), NodeFit, dtype=np.int8)
+    nodeClass[wetNum < MinWetYears] = NodeSparse
+    nodeClass[annual.max(axis=1) == annual.min(axis=1)] = NodeConstant
+    nodeClass[wetNum == 0] = NodeDry
+    return nodeClass
+
+## Fit GEV to a block of annual maxima (nodes, years): shape, location, scale, KS p-value and class of each node
+def FitGevBlock(annual):
+    sample = np.sort(np.asarray(annual, dtype=np.float64), axis=1)
+    nodeClass = ClassifyNodes(sample)
+    arg = np.full((len(sample), 5), MaskValue)  # Masked nodes (too few nonzero years)
+    arg[:, 4] = nodeClass
+    degenerate = (nodeClass == NodeDry) | (nodeClass == NodeConstant)  # Point masses: every return level is the value
+    arg[degenerate, :4] = np.column_stack([np.zeros(degenerate.sum()), sample[degenerate, -1], np.zeros(degenerate.sum()),
+                                           np.ones(degenerate.sum())])  # Fits the sample exactly
+    fit = nodeClass == NodeFit
+    c, loc, scale = FitGevPwm(sample[fit])
+    if GevMethod == "MLE":
+        c, loc, scale = FitGevMle(sample[fit], c, loc, scale)
+    arg[fit, :4] = np.column_stack([c, loc, scale, KsPvalue(sample[fit], c, loc, scale)])
+    return arg
 
 # Return period calculation ========================================================= #
 
@@ -85,79 +254,108 @@ def ReturnPeriod(t):
     p = 1.0 - 1.0 / t
     return p
 
-## Convert csv file to maxele.63 format
-def WriteMaxele63(input_path, output_path, period):
-    df = pd.read_csv(input_path)
-    periodid = "RP" + str(10000 + period)[-4:]
+## Column name of a return period
+def PeriodID(period):
+    return "RP" + str(period).zfill(4)
+
+## GEV return levels (nodes, periods) of all nodes and return periods in one broadcast
+def ReturnLevel(c, loc, scale, listPeriod):
+    c, loc, scale = (np.asarray(value, dtype=np.float64)[:, None] for value in (c, loc, scale))
+    y = -np.log(ReturnPeriod(np.asarray(listPeriod, dtype=np.float64)))[None, :]  # Reduced variate
+    with np.errstate(all="ignore"):
+        gumbel = np.abs(c) < 1e-8
+        cSafe = np.where(gumbel, 1.0, c)
+        return loc + scale * np.where(gumbel, -np.log(y), (1 - y ** cSafe) / cSafe)
+
+## Write node values in maxele.63 format
+def WriteMaxele63(listNID, listValue, output_path):
     with open(output_path, mode='w') as Fort63:
         Fort63.write("!  \n")
-        Fort63.write("!  " + str(len(df)) + "\n")
+        Fort63.write("!  " + str(len(listNID)) + "\n")
         Fort63.write("!  \n") 
-        for i in df.index:
-            dfTemp = df.iloc[i]
-            nid = int(dfTemp["NID"])
-            maxele = dfTemp[periodid]
-            Fort63.write(f"{nid}    {maxele}\n")
-
-## Pair maxele.63 with fort.14 to add locations into csv
-def MergeMaxele63Fort14(fort14_path, maxele63_path, output_path):
-    # Read Node attributes from fort.14
-    with open(fort14_path, 'r') as Fort14: 
-        lines14 = Fort14.readlines()
-        meta = lines14[1].split() 
-        nodeNum = int(meta[1])  # Number of nodes
-        fort14List = []
-        for i in range(nodeNum):
-            temp = lines14[2 + i].split() 
-            temp[0] = int(temp[0])
-            for j in range(1, 4):
-                temp[j] = float(temp[j])
-            fort14List.append(temp[0:3])
-    # Read Node water levels from maxele.63
-    with open(maxele63_path, 'r') as Maxele: 
-        lines63 = Maxele.readlines()
-        meta = lines63[1].split() 
-        nodeNum = int(meta[1])  # Number of nodes
-        array = np.empty(nodeNum + 1)
-        MaxeleList = []          
-        tempList = []
-        for i in range(nodeNum):
-            temp = lines63[i + 3].split() 
-            array[i] = temp[1]     
-            temp = float(temp[1])
-            tempList.append(temp)
-        MaxeleList.append(tempList)
-        MaxeleList = list(map(list, zip(*MaxeleList)))
-    # Merge fort.14 and maxele.63 information 
-    List = []
-    for i in range(nodeNum):
-        List.append(fort14List[i] + MaxeleList[i])
-    df = pd.DataFrame(List)
-    Header = ['ID', 'lon', 'lat', 'surge']
-    df.to_csv(output_path, header=Header, index=False)
-
-## Calculate return periods by GEV fittings
-df_arg = pd.read_csv(gev_path)
-listNID = df_arg["NID"]
-df_return = pd.DataFrame()
-for period in listReturnPeriod:
-    prob = ReturnPeriod(period)
-    listPredict = []
-    for i in range(len(df_arg)):
-        dfTemp = df_arg.iloc[i]
-        predict = stats.genextreme.ppf(prob, dfTemp["Shape"], dfTemp["Location"], dfTemp["Scale"])
-        listPredict.append(predict)
-        print(i)
-    df_return["RP" + str(10000 + period)[-4:]] = listPredict
-df_return.insert(loc=0, column='NID', value=listNID)
-df_return.to_csv(return_path, index=False)
-
-## Add locations to csv files
-for period in listReturnPeriod:
-    periodid = "RP" + str(10000 + period)[-4:]
-    return_path_63 = os.path.join(return_dir, periodid+r".63")
-    return_path_csv = os.path.join(return_dir, periodid+r".csv")  
-    WriteMaxele63(return_path, return_path_63, period)
-    print(return_path_63)
-    MergeMaxele63Fort14(fort14_path_in, return_path_63, return_path_csv)
-    print(return_path_csv)
\ No newline at end of file
+        Fort63.write("".join(f"{nid}    {maxele}\n" for nid, maxele in zip(listNID, listValue)))
+
+## Return levels of bootstrap replicates [start, stop) of a block of annual maxima, (replicates, nodes, periods)
+def BootstrapBlock(annual, nodeClass, start, stop):
+    sample = np.asarray(annual, dtype=np.float64)
+    n = sample.shape[1]
+    level = np.empty((stop - start, len(sample), len(listReturnPeriod)))
+    level[:] = np.where(nodeClass == NodeSparse, MaskValue, sample.max(axis=1))[None, :, None]  # Masked nodes
+    fit = nodeClass == NodeFit
+    sample = sample[fit]
+    for r in range(start, stop):
+        rng = np.random.default_rng([BootstrapSeed, r])  # Same draw for every node block, whatever the worker
+        resample = np.sort(sample[:, rng.integers(0, n, n)], axis=1)  # Same years for every node (columns are ranks with SurgeSource = "Sort")
+        level[r - start, fit] = ReturnLevel(*FitGevPwm(resample), listReturnPeriod)
+    return level
+
+## Lower and upper bootstrap bounds of return levels for all nodes, (nodes, periods) each
+def BootstrapBands(pool, mask):
+    listStart = list(range(0, BootstrapNum, ReplicateBlock))
+    listLower, listUpper = [], []
+    node = 0
+    for annual in IterAnnualMax():
+        listTask = [(start, replicate) for start in range(0, len(annual), FitBlock) for replicate in listStart]
+        results = iter(pool.map(BootstrapBlock, [annual[start:start + FitBlock] for start, _ in listTask],
+                                [mask[node + start:node + min(start + FitBlock, len(annual))] for start, _ in listTask],
+                                [replicate for _, replicate in listTask],
+                                [min(replicate + ReplicateBlock, BootstrapNum) for _, replicate in listTask]))
+        for _ in range(0, len(annual), FitBlock):
+            level = np.concatenate([next(results) for _ in listStart], axis=0)
+            lower, upper = np.quantile(level, [(1 - Confidence) / 2, (1 + Confidence) / 2], axis=0)
+            listLower.append(lower)
+            listUpper.append(upper)
+        node += len(annual)
+    return np.vstack(listLower), np.vstack(listUpper)
+
+## Pair node values with the mesh nodes to add locations into csv
+def MergeFort14(mesh, listValue, output_path, dfBand=None):
+    # Join node ids and locations of the mesh by row
+    nodes = mesh["nodes"][:len(listValue)]
+    df = pd.DataFrame({"ID": nodes[:, 0].astype(np.int64), "lon": nodes[:, 1], "lat": nodes[:, 2], "surge": listValue})
+    if dfBand is not None:  # Confidence bands
+        df = pd.concat([df, dfBand.reset_index(drop=True)], axis=1)
+    df.to_csv(output_path, index=False)
+
+if __name__ == "__main__":
+
+    ## GEV fittings by node blocks
+    listBlock = (annual[start:start + FitBlock] for annual in IterAnnualMax() for start in range(0, len(annual), FitBlock))
+    with ProcessPoolExecutor(max_workers=WorkerNum) as pool:
+        arg = np.vstack(list(pool.map(FitGevBlock, listBlock)))
+        mask = arg[:, 4].astype(np.int8)
+        if BootstrapNum > 0:  # Confidence bands of return levels
+            lower, upper = BootstrapBands(pool, mask)
+    np.save(mask_path, mask)
+    print(mask_path)
+    
+    df_arg = pd.DataFrame(arg[:, :4], columns=["Shape", "Location", "Scale", "P-value"])
+    df_arg.insert(loc=0, column='NID', value=np.arange(1, len(arg) + 1))
+    df_arg["Class"] = mask  # NodeFit, NodeDry, NodeConstant or NodeSparse
+    df_arg.to_csv(gev_path, index=False)
+    print(gev_path)
+    
+    ## Calculate return periods by GEV fittings
+    level = ReturnLevel(df_arg["Shape"], df_arg["Location"], df_arg["Scale"], listReturnPeriod)
+    level[mask == NodeSparse] = MaskValue  # Parameters of masked nodes are sentinels, not a distribution
+    listNID = df_arg["NID"].to_numpy()
+    df_return = pd.DataFrame(level, columns=[PeriodID(period) for period in listReturnPeriod])
+    if BootstrapNum > 0:
+        for j, period in enumerate(listReturnPeriod):
+            df_return[PeriodID(period) + "_Lower"] = lower[:, j]
+            df_return[PeriodID(period) + "_Upper"] = upper[:, j]
+    df_return.insert(loc=0, column='NID', value=listNID)
+    df_return.to_csv(return_path, index=False)
+    print(return_path)
+
+    ## Add locations to csv files
+    mesh = LoadMesh(fort14_path_in)
+    for j, period in enumerate(listReturnPeriod):
+        periodid = PeriodID(period)
+        return_path_63 = os.path.join(return_dir, periodid+r".63")
+        return_path_csv = os.path.join(return_dir, periodid+r".csv")  
+        WriteMaxele63(listNID, level[:, j], return_path_63)
+        print(return_path_63)
+        dfBand = pd.DataFrame({"lower": lower[:, j], "upper": upper[:, j]}) if BootstrapNum > 0 else None
+        MergeFort14(mesh, level[:, j], return_path_csv, dfBand)  # From the levels in memory, not the .63 written above
+        print(return_path_csv)
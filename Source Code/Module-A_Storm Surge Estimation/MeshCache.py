@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Author: Ziying Zhou
+# Date: June 18, 2024
+# Description: This module holds the fort.14 parser and the binary mesh cache shared by the Module A and Module B scripts.
+
+################################## Initialization Settings ######################################
+
+# Importing necessary Python packages --------------------------- #
+
+import os
+import json
+import hashlib
+import itertools
+import numpy as np
+from scipy.spatial import cKDTree
+
+######################################## Main Program ###########################################
+
+# Mesh cache ======================================================================== #
+
+## Content hash of a file, read in blocks
+def FileHash(file_path, blockSize=1 << 24):
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as File:
+        for block in iter(lambda: File.read(blockSize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+## Node ids of one boundary segment per line group, read from the first column
+def ReadBoundaries(Fort14, segmentNum):
+    listNode, listOffset, listType = [], [0], []
+    for _ in range(segmentNum):
+        head = Fort14.readline().split()
+        lineNum = int(head[0])
+        hasType = len(head) > 1 and head[1].lstrip("-").isdigit()  # Open boundaries carry no type, only a "= ..." comment
+        listType.append(int(head[1]) if hasType else -1)
+        listNode.extend(int(line.split()[0]) for line in itertools.islice(Fort14, lineNum))
+        listOffset.append(len(listNode))
+    return np.array(listNode, dtype=np.int64), np.array(listOffset, dtype=np.int64), np.array(listType, dtype=np.int32)
+
+## Parse fort.14: nodes (id, lon, lat, depth), elements (node rows) and open/land boundary segments (node rows)
+def ReadFort14(fort14_path):
+    with open(fort14_path, 'r') as Fort14:
+        Fort14.readline()
+        elementNum, nodeNum = (int(value) for value in Fort14.readline().split()[:2])
+        nodes = np.fromstring("".join(itertools.islice(Fort14, nodeNum)), sep=" ").reshape(nodeNum, 4)
+        elements = np.fromstring("".join(itertools.islice(Fort14, elementNum)), sep=" ").reshape(elementNum, 5)
+        row = np.empty(int(nodes[:, 0].max()) + 1, dtype=np.int64)  # Node id -> row
+        row[nodes[:, 0].astype(np.int64)] = np.arange(nodeNum)
+        mesh = {"nodes": nodes, "elements": row[elements[:, 2:].astype(np.int64)].astype(np.int32)}
+        for name in ["open", "land"]:
+            line = Fort14.readline().split()
+            segmentNum = int(line[0]) if line else 0  # Mesh without boundary information
+            if segmentNum:
+                Fort14.readline()  # Total number of boundary nodes
+            node, offset, kind = ReadBoundaries(Fort14, segmentNum)
+            mesh[name + "Nodes"], mesh[name + "Offsets"], mesh[name + "Types"] = row[node].astype(np.int32), offset, kind
+    return mesh
+
+## Load the mesh from its binary cache (memory-mapped), parsing fort.14 only when its content changed
+def LoadMesh(fort14_path):
+    cache_dir = os.path.join(os.path.dirname(fort14_path), "Mesh_" + FileHash(fort14_path)[:16])
+    if not os.path.exists(os.path.join(cache_dir, "Mesh.json")):
+        mesh = ReadFort14(fort14_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        for name, array in mesh.items():
+            np.save(os.path.join(cache_dir, name + ".npy"), array)
+        with open(os.path.join(cache_dir, "Mesh.json"), 'w') as mesh_file:  # Written last, marks a complete cache
+            json.dump({"source": os.path.basename(fort14_path), "nodes": len(mesh["nodes"]),
+                       "elements": len(mesh["elements"]), "arrays": list(mesh)}, mesh_file, indent=1)
+    with open(os.path.join(cache_dir, "Mesh.json"), 'r') as mesh_file:
+        listName = json.load(mesh_file)["arrays"]
+    return {name: np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r") for name in listName}
+
+# Mesh index ======================================================================== #
+
+## Rows of mesh nodes by node id
+def NodeRows(mesh, listNID):
+    nodeID = mesh["nodes"][:, 0].astype(np.int64)
+    row = np.full(nodeID.max() + 1, -1, dtype=np.int64)
+    row[nodeID] = np.arange(len(nodeID))
+    return row[listNID]
+
+## Spatial index of mesh nodes (lon, lat), built on first use and kept with the mesh
+def NodeTree(mesh):
+    if "nodeTree" not in mesh:
+        mesh["nodeTree"] = cKDTree(mesh["nodes"][:, 1:3])
+    return mesh["nodeTree"]
+
+## Spatial index of element centroids (lon, lat), built on first use and kept with the mesh
+def ElementTree(mesh):
+    if "elementTree" not in mesh:
+        mesh["elementTree"] = cKDTree(mesh["nodes"][:, 1:3][mesh["elements"]].mean(axis=1))
+    return mesh["elementTree"]
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# Author: Ziying Zhou
+# Date: June 18, 2024
+# Description: This module holds the NetCDF readers and the surge cube shared by the Module A scripts.
+
+################################## Initialization Settings ######################################
+
+# Importing necessary Python packages --------------------------- #
+
+import os
+import json
+import numpy as np
+from scipy.io import netcdf_file
+
+try:  # NetCDF4 (HDF5) outputs of ADCIRC, classic NetCDF files are read by scipy
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+######################################## Main Program ###########################################
+
+# NetCDF outputs ==================================================================== #
+
+## Whether a file is NetCDF (classic, 64-bit offset or NetCDF4/HDF5), judged by its leading bytes
+def IsNetCDF(file_path):
+    with open(file_path, 'rb') as File:
+        magic = File.read(8)
+    return magic[:4] in (b"CDF\x01", b"CDF\x02") or magic == b"\x89HDF\r\n\x1a\n"
+
+## Open a NetCDF file for lazy slicing, keeping the ADCIRC fill value of dry nodes
+def OpenNetCDF(file_path):
+    if netCDF4 is not None:
+        dataset = netCDF4.Dataset(file_path)
+        dataset.set_auto_mask(False)
+        return dataset
+    with open(file_path, 'rb') as File:
+        if File.read(4) not in (b"CDF\x01", b"CDF\x02"):
+            raise ImportError("netCDF4 is required to read " + file_path)
+    return netcdf_file(file_path, 'r', mmap=True)
+
+# Surge cube ======================================================================== #
+
+## Read the index of a surge cube (None if the cube does not exist yet)
+def ReadCubeIndex(cube_dir):
+    index_path = os.path.join(cube_dir, "Index.json")
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r') as index_file:
+        return json.load(index_file)
+
+## Append runs (nodes, runs) to a surge cube as new run chunks, leaving existing blocks untouched
+def AppendCube(cube_dir, surge, listREid, nodeChunk=100000, runChunk=256):
+    index = ReadCubeIndex(cube_dir)
+    if index is None:
+        os.makedirs(cube_dir, exist_ok=True)
+        index = {"nodes": surge.shape[0], "dtype": surge.dtype.str, "nodeChunk": nodeChunk,
+                 "runs": [], "runChunks": []}
+    if surge.shape[0] != index["nodes"]:
+        raise ValueError(f"Cube has {index['nodes']} nodes, runs have {surge.shape[0]}")
+    nodeChunk = index["nodeChunk"]
+    for start in range(0, len(listREid), runChunk):
+        stop = min(start + runChunk, len(listREid))
+        r = len(index["runChunks"])
+        for n, nodeStart in enumerate(range(0, index["nodes"], nodeChunk)):
+            block = surge[nodeStart:nodeStart + nodeChunk, start:stop].astype(index["dtype"])
+            np.save(os.path.join(cube_dir, f"N{n:04d}_R{r:04d}.npy"), block)
+        offset = len(index["runs"])
+        index["runChunks"].append([offset, offset + stop - start])
+        index["runs"].extend(listREid[start:stop])
+    temp_path = os.path.join(cube_dir, "Index.json.tmp")
+    with open(temp_path, 'w') as index_file:
+        json.dump(index, index_file, indent=1)
+    os.replace(temp_path, os.path.join(cube_dir, "Index.json"))  # New runs become visible at once
+    return index
+
+## Read a node range and a set of runs from a surge cube, loading only the blocks that overlap
+def ReadCube(cube_dir, nodeRange=None, listREid=None, index=None):
+    index = index or ReadCubeIndex(cube_dir)
+    nodeStart, nodeStop = nodeRange or (0, index["nodes"])
+    position = {reid: j for j, reid in enumerate(index["runs"])}
+    columns = np.arange(len(index["runs"])) if listREid is None else np.array([position[reid] for reid in listREid], dtype=int)
+    surge = np.empty((nodeStop - nodeStart, len(columns)), dtype=index["dtype"])
+    nodeChunk = index["nodeChunk"]
+    for r, (runStart, runStop) in enumerate(index["runChunks"]):
+        inChunk = np.flatnonzero((columns >= runStart) & (columns < runStop))
+        if len(inChunk) == 0:
+            continue
+        for n in range(nodeStart // nodeChunk, (nodeStop - 1) // nodeChunk + 1):
+            block = np.load(os.path.join(cube_dir, f"N{n:04d}_R{r:04d}.npy"), mmap_mode="r")
+            lo, hi = max(nodeStart, n * nodeChunk), min(nodeStop, (n + 1) * nodeChunk)
+            surge[lo - nodeStart:hi - nodeStart, inChunk] = block[lo - n * nodeChunk:hi - n * nodeChunk][:, columns[inChunk] - runStart]
+    return surge
+
+## Annual maxima of a (nodes, runs) surge matrix, reduced over the runs of each year
+def AnnualMax(surge, listYear, yearNum, blockSize=100000):
+    order = np.argsort(listYear, kind="stable")
+    present, starts = np.unique(np.asarray(listYear)[order], return_index=True)
+    annual = np.zeros((surge.shape[0], yearNum), dtype=surge.dtype)  # Years without storms stay zero
+    if len(order) == 0:
+        return annual
+    for start in range(0, surge.shape[0], blockSize):
+        block = surge[start:start + blockSize][:, order]  # Runs grouped by year
+        annual[start:start + blockSize, present] = np.maximum.reduceat(block, starts, axis=1)
+    return annual
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Author: Ziying Zhou
+# Date: June 18, 2024
+# Description: This module holds the columnar store of tables (one binary file per column) shared by the Module A scripts.
+
+################################## Initialization Settings ######################################
+
+# Importing necessary Python packages --------------------------- #
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+######################################## Main Program ###########################################
+
+# Columnar store ==================================================================== #
+
+## Write (or append) a table into a columnar store
+def WriteStore(store_dir, df, append=False):
+    schema_path = os.path.join(store_dir, "Schema.json")
+    if append and os.path.exists(schema_path):
+        with open(schema_path, 'r') as schema_file:
+            schema = json.load(schema_file)
+    else:
+        os.makedirs(store_dir, exist_ok=True)
+        schema = {"columns": {}, "rows": 0}
+        for column in df.columns:
+            values = df[column].to_numpy()
+            if values.dtype.kind in "OUT":
+                values = values.astype(str)  # Fixed-width strings
+            schema["columns"][column] = values.dtype.str
+            open(os.path.join(store_dir, column + ".bin"), 'wb').close()
+    for column, dtype in schema["columns"].items():
+        values = np.ascontiguousarray(df[column].to_numpy(), dtype=dtype)
+        with open(os.path.join(store_dir, column + ".bin"), 'ab') as column_file:
+            column_file.write(values.tobytes())
+    schema["rows"] += len(df)
+    with open(schema_path, 'w') as schema_file:
+        json.dump(schema, schema_file, indent=1)
+
+## Read a table from a columnar store (columns are memory-mapped)
+def ReadStore(store_dir, usecols=None):
+    with open(os.path.join(store_dir, "Schema.json"), 'r') as schema_file:
+        schema = json.load(schema_file)
+    data = {}
+    for column, dtype in schema["columns"].items():
+        if usecols is not None and column not in usecols:
+            continue
+        if schema["rows"] == 0:
+            data[column] = np.empty(0, dtype=dtype)
+        else:
+            data[column] = np.memmap(os.path.join(store_dir, column + ".bin"), dtype=dtype,
+                                     mode='r', shape=(schema["rows"],))
+    return pd.DataFrame(data)
+
+# Partitioned tables ======================================================== #
+
+## Sort a table by key and locate the rows of every partition
+def PartitionTable(df, key, naming=str, listKey=None):
+    keys = df[key].to_numpy()
+    if keys.dtype.kind == "O":
+        keys = keys.astype(str)
+    order = np.argsort(keys, kind="stable")
+    dfSort = df.iloc[order].reset_index(drop=True)
+    sortKey = keys[order]
+    if listKey is None:
+        listKey = np.unique(sortKey)
+    starts = np.searchsorted(sortKey, listKey, side="left")
+    stops = np.searchsorted(sortKey, listKey, side="right")
+    index = {naming(k): [int(start), int(stop)] for k, start, stop in zip(listKey, starts, stops)}
+    return dfSort, index
+
+## Write (or append) a table partitioned by key in one pass (sorted columnar store + partition index)
+def WritePartitions(df, key, store_dir, naming=str, listKey=None, xlsx=False, append=False):
+    dfSort, index = PartitionTable(df, key, naming, listKey)
+    index_path = os.path.join(store_dir, "Index.json")
+    fullIndex = {}
+    offset = 0
+    if append and os.path.exists(index_path):
+        with open(index_path, 'r') as index_file:
+            fullIndex = json.load(index_file)
+        with open(os.path.join(store_dir, "Schema.json"), 'r') as schema_file:
+            offset = json.load(schema_file)["rows"]
+    WriteStore(store_dir, dfSort, append=append)
+    fullIndex.update({name: [start + offset, stop + offset] for name, (start, stop) in index.items()})
+    with open(index_path, 'w') as index_file:
+        json.dump(fullIndex, index_file, indent=1)
+    if xlsx:
+        for name, (start, stop) in index.items():
+            dfSort.iloc[start:stop].to_excel(os.path.join(store_dir, name + ".xlsx"), index=False)
+    return index
@@ -9,7 +9,14 @@
 # Importing necessary Python packages --------------------------- #
 
 import os
+import sys
 import arcpy
+import pandas as pd
+import numpy as np
+from scipy.spatial import cKDTree
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Module-A_Storm Surge Estimation"))
+from MeshCache import FileHash, LoadMesh, NodeRows, ElementTree  # Mesh cache shared with Module A
 
 # Input/Output settings ----------------------------------------- #
 
@@ -19,6 +26,9 @@ ModuleA_dir = os.path.join(root, r"ModuleA")
 ModuleB_dir = os.path.join(root, r"ModuleB")
 
 return_dir = os.path.join(ModuleA_dir, "ReturnPeriod")  # Folder for return periods
+fort14_path = os.path.join(ModuleA_dir, "Prepare", "fort.14") # Fort14 file (mesh cache is kept next to it)
+return_path = os.path.join(return_dir, "ReturnPeriod_NID.csv") # Return periods sorted by NID
+mask_path = os.path.join(ModuleA_dir, "GEV", "NodeMask.npy") # Node classes of the GEV fittings (nodes,)
 
 prepare_dir = os.path.join(ModuleB_dir, "Prepare")  # Folder for prepared data
 surge_dir = os.path.join(ModuleB_dir, "StormSurge")  # Folder for storm surge data
@@ -30,6 +40,24 @@ buf500m_path = os.path.join(prepare_dir, "Hainan_Buffer500m.shp") # Buffer of Ha
 coastline_path = os.path.join(prepare_dir, "Coastline_point.shp") # Coastline of Hainan Island
 dem_path = os.path.join(prepare_dir, "dem.tif") # DEM data
 
+# Interpolation settings ---------------------------------------- #
+
+## Interpolation: "IDW" over the erased points, or "Mesh" (barycentric in fort.14 triangles, IDW outside them)
+InterpMode = "Mesh"
+
+## Nearest element centroids searched for the triangle containing a cell centre
+MeshCandidates = 16
+
+## Inverse distance weighting: power and number of nearest points (as "VARIABLE 12" of arcpy.ddd.Idw)
+IdwPower = 2
+IdwNeighbors = 12
+
+## DEM rows interpolated at a time
+RowBlock = 256
+
+## Threads of the nearest-point queries
+WorkerNum = os.cpu_count()
+
 # Spatial reference --------------------------------------------- #
 
 ## Geographic coordinate system
@@ -57,43 +85,171 @@ listSurge = [r"0010a", r"0020a", r"0050a", r"0100a"]
 listTide = [r"H", r"M"]
 listSLR = [r"SSP0", r"SSP1", r"SSP5"]
 
+## Node classes of the GEV mask (A-4): fitted, all zero, constant, too few nonzero years
+NodeFit, NodeDry, NodeConstant, NodeSparse = 0, 1, 2, 3
+
 ######################################## Main Program ###########################################
 
+# Inverse distance weighting ======================================================= #
+
+## Valid cells of the DEM grid (rows, cols), the cells interpolated under the DEM mask
+def ReadGrid(dem):
+    values = arcpy.RasterToNumPyArray(dem)
+    if dem.noDataValue is None:
+        return np.ones(values.shape, dtype=bool)
+    return values != dem.noDataValue
+
+## Nearest points and inverse-distance weights of cell centres (cells, 2), (cells, neighbors) each
+def IdwWeights(tree, xy, neighbors=IdwNeighbors, power=IdwPower):
+    distance, index = tree.query(xy, k=min(neighbors, tree.n), workers=WorkerNum)
+    distance, index = distance.reshape(len(xy), -1), index.reshape(len(xy), -1)
+    with np.errstate(divide="ignore"):
+        weight = distance ** -float(power)
+    exact = np.isinf(weight).any(axis=1)  # Cell centre on a point: take its value
+    weight[exact] = np.isinf(weight[exact])
+    return index, weight / weight.sum(axis=1, keepdims=True)
+
+## Interpolate point values (points, fields) onto the valid DEM cells in row tiles, (fields, rows, cols)
+def IdwGrid(tree, values, dem, valid, rowBlock=RowBlock):
+    rows, cols = valid.shape
+    grid = np.full((values.shape[1], rows, cols), np.nan, dtype=np.float32)
+    x = dem.extent.XMin + (np.arange(cols) + 0.5) * dem.meanCellWidth
+    for start in range(0, rows, rowBlock):
+        r, c = np.nonzero(valid[start:start + rowBlock])
+        y = dem.extent.YMax - (start + r + 0.5) * dem.meanCellHeight
+        index, weight = IdwWeights(tree, np.column_stack([x[c], y]))
+        for f in range(values.shape[1]):  # Neighbours and weights are shared by all fields
+            grid[f, start + r, c] = (weight * values[index, f]).sum(axis=1)
+    return grid
+
+## Save a grid aligned with the DEM as a raster
+def SaveGrid(grid, dem, output_path):
+    raster = arcpy.NumPyArrayToRaster(grid, arcpy.Point(dem.extent.XMin, dem.extent.YMin),
+                                      dem.meanCellWidth, dem.meanCellHeight, np.nan)
+    raster.save(output_path)
+    arcpy.management.DefineProjection(output_path, dem.spatialReference)
+    return arcpy.Raster(output_path)
+
+# Barycentric interpolation in mesh triangles ======================================= #
+
+## Containing triangles and barycentric weights of cell centres (cells, 2), -1 where no candidate contains the centre
+def LocateElements(mesh, elementTree, xy, candidates=MeshCandidates):
+    nodes, elements = mesh["nodes"], mesh["elements"]
+    _, index = elementTree.query(xy, k=min(candidates, elementTree.n), workers=WorkerNum)
+    index = index.reshape(len(xy), -1)
+    element = np.full(len(xy), -1, dtype=np.int32)
+    weight = np.zeros((len(xy), 3), dtype=np.float32)
+    for j in range(index.shape[1]):  # Nearest candidates first, only for cells still unmatched
+        cell = np.flatnonzero(element < 0)
+        if len(cell) == 0:
+            break
+        vertex = nodes[:, 1:3][elements[index[cell, j]]]  # (cells, 3, 2)
+        b, c, p = vertex[:, 1] - vertex[:, 0], vertex[:, 2] - vertex[:, 0], xy[cell] - vertex[:, 0]  # Edges and point from the first vertex
+        with np.errstate(all="ignore"):
+            det = b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0]
+            l1 = (p[:, 0] * c[:, 1] - p[:, 1] * c[:, 0]) / det
+            l2 = (b[:, 0] * p[:, 1] - b[:, 1] * p[:, 0]) / det
+        l0 = 1 - l1 - l2
+        inside = (l0 >= -1e-9) & (l1 >= -1e-9) & (l2 >= -1e-9)
+        element[cell[inside]] = index[cell[inside], j]
+        weight[cell[inside]] = np.column_stack([l0, l1, l2])[inside]
+    return element, weight
+
+## Cell -> element index of the valid DEM cells: flat cell numbers, elements and barycentric weights
+def CellElementIndex(mesh, dem, valid, rowBlock=RowBlock):
+    elementTree = ElementTree(mesh)
+    rows, cols = valid.shape
+    x = dem.extent.XMin + (np.arange(cols) + 0.5) * dem.meanCellWidth
+    listCell, listElement, listWeight = [], [], []
+    for start in range(0, rows, rowBlock):
+        r, c = np.nonzero(valid[start:start + rowBlock])
+        y = dem.extent.YMax - (start + r + 0.5) * dem.meanCellHeight
+        element, weight = LocateElements(mesh, elementTree, np.column_stack([x[c], y]))
+        found = element >= 0
+        listCell.append(((start + r) * cols + c)[found])
+        listElement.append(element[found])
+        listWeight.append(weight[found])
+    return np.concatenate(listCell), np.concatenate(listElement), np.concatenate(listWeight)
+
+## Load the cell -> element index of a mesh and DEM pair from its cache, building it when either file changed
+def LoadCellIndex(mesh, dem, valid):
+    cache_path = os.path.join(prepare_dir, "CellElement_" + FileHash(fort14_path)[:16] + "_" + FileHash(dem_path)[:16] + ".npz")
+    if not os.path.exists(cache_path):
+        cell, element, weight = CellElementIndex(mesh, dem, valid)
+        temp_path = cache_path + ".tmp"
+        with open(temp_path, 'wb') as Cache:
+            np.savez(Cache, cell=cell, element=element, weight=weight)
+        os.replace(temp_path, cache_path)
+    with np.load(cache_path) as index:
+        return index["cell"], index["element"], index["weight"]
+
+## Rasterize node fields (mesh nodes, fields) by the cell -> element index, NaN outside usable triangles
+def MeshGrid(mesh, cellIndex, field, shape):
+    cell, element, weight = cellIndex
+    vertex = np.asarray(mesh["elements"])[element]  # (cells, 3)
+    usable = ~np.isnan(field[vertex]).any(axis=(1, 2))  # Triangles without erased or masked nodes
+    cell, vertex, weight = cell[usable], vertex[usable], weight[usable]
+    grid = np.full((field.shape[1], shape[0] * shape[1]), np.nan, dtype=np.float32)
+    for f in range(field.shape[1]):  # Gather and weighted sum
+        grid[f, cell] = (weight * field[vertex, f]).sum(axis=1)
+    return grid.reshape(field.shape[1], *shape)
+
 # Generate storm surge raster ======================================================= #
 
+## Locations of nodes with return levels, leaving out nodes masked without a fit
+mesh = LoadMesh(fort14_path)
+df_return = pd.read_csv(return_path)
+df_return = df_return[np.load(mask_path) != NodeSparse].reset_index(drop=True)
+nodes = mesh["nodes"][NodeRows(mesh, df_return["NID"].to_numpy())]
+listPeriodID = [str(10000 + period)[-4:] for period in listReturnPeriod]
+
+point_path_csv = os.path.join(surge_dir, 'point.csv')
+point_path = os.path.join(surge_dir, 'point.shp')
+erase_path = os.path.join(surge_dir, 'erase.shp')
+
+## Generate points(.shp) of all return periods
+df_point = pd.DataFrame({"ID": df_return["NID"], "lon": nodes[:, 1], "lat": nodes[:, 2]})
+df_point.to_csv(point_path_csv, index=False)
+tempLayer = os.path.basename(point_path_csv)
+arcpy.MakeXYEventLayer_management(table=point_path_csv,
+                                  in_x_field="lon", in_y_field="lat",
+                                  out_layer=tempLayer,
+                                  spatial_reference=GCSReference,
+                                  in_z_field="")
+arcpy.CopyFeatures_management(tempLayer, point_path)
+print("Completed generating vector points")
+
+## Erase internal points
+arcpy.analysis.Erase(in_features=point_path, erase_features=buf500m_path,
+                     out_feature_class=erase_path, cluster_tolerance="")
+listID = [row[0] for row in arcpy.da.SearchCursor(erase_path, ["ID"])]
+keep = np.isin(df_return["NID"].to_numpy(), listID)
+print("Completed erasing internal vector points")
+
+## Interpolate rasters of all return periods with shared neighbours and weights
+dem = arcpy.Raster(dem_path)
+valid = ReadGrid(dem)
+tree = cKDTree(nodes[keep][:, 1:3])  # Only the nodes left after erasing internal points
+values = df_return.loc[keep, ["RP" + periodid for periodid in listPeriodID]].to_numpy(dtype=np.float64)
+if InterpMode == "Mesh":
+    field = np.full((len(mesh["nodes"]), len(listPeriodID)), np.nan)
+    field[NodeRows(mesh, df_return.loc[keep, "NID"].to_numpy())] = values
+    grid = MeshGrid(mesh, LoadCellIndex(mesh, dem, valid), field, valid.shape)
+    outside = valid & np.isnan(grid[0])  # Cells beyond the usable triangles
+    grid[:, outside] = IdwGrid(tree, values, dem, outside)[:, outside]
+else:
+    grid = IdwGrid(tree, values, dem, valid)
+print("Completed raster interpolation")
+
 for i in range(len(listReturnPeriod)):
     
-    period = listReturnPeriod[i]
-    periodid = str(10000 + period)[-4:]
-
-    return_path_csv = os.path.join(return_dir, r"RP"+periodid+r".csv") 
+    periodid = listPeriodID[i]
 
-    point_path = os.path.join(surge_dir, 'point' + periodid + '.shp')
-    erase_path = os.path.join(surge_dir, 'erase' + periodid + '.shp')
     surge_path = os.path.join(surge_dir, 'S' + periodid + 'a.tif') 
     extract_path = os.path.join(surge_dir, 'Coastline' + periodid + '.shp') 
- 
-    ## Generate points(.shp)
-    tempLayer = os.path.basename(return_path_csv)
-    arcpy.MakeXYEventLayer_management(table=return_path_csv,
-                                      in_x_field="lon", in_y_field="lat",
-                                      out_layer=tempLayer,
-                                      spatial_reference=GCSReference,
-                                      in_z_field="")
-    arcpy.CopyFeatures_management(tempLayer, point_path)
-    print("Completed generating vector points")
     
-    ## Erase internal points
-    arcpy.analysis.Erase(in_features=point_path, erase_features=buf500m_path,
-                         out_feature_class=erase_path, cluster_tolerance="")
-    print("Completed erasing internal vector points")
-                
-    ## Interpolate raster
-    surgeRaster = arcpy.ddd.Idw(in_point_features=erase_path, z_field="surge",
-                                out_raster=surge_path, cell_size=dem_path,
-                                power=2, search_radius="VARIABLE 12",
-                                in_barrier_polyline_features="")
-    print("Completed raster interpolation")   
+    surgeRaster = SaveGrid(grid[i], dem, surge_path)
+    print(surge_path)
     
     ## Extract values at coastline
     arcpy.CopyFeatures_management(coastline_path, extract_path)